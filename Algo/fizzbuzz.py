@@ -1,31 +1,387 @@
 # Bonus
-import os, sys
+import argparse, json, math, os, shutil, sys
+from bisect import bisect_left
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from typing import Iterable, Iterator
+
+try:
+    import numpy as np
+except ImportError: # the numpy engine is optional
+    np = None
 
 base_dir = os.path.dirname(os.path.abspath(__file__))
 output_dir = os.path.join(base_dir, "output")
 
-def fizzbuzz(n: int, divisors: dict) -> list:
-    result = []
-    for i in range(1, n+1):
+CHUNK_SIZE = 1 << 16 # lines buffered in memory before each write
+TEMPLATE_CHUNKS = 8 # largest cycle template, in chunks
+ECHO_LIMIT = 1000 # above this, results are only exported to file
+MAX_CYCLE = 1 << 16 # rule sets with a larger lcm fall back to the modulo loop
+STAMP_DIGITS = 4 # trailing digits of each number baked into the cycle template
+WORKERS = os.cpu_count() or 1 # processes used to render shards in parallel
+SHARD_SIZE = 1 << 24 # lines per shard, above this n is split across WORKERS
+CACHE_MAX_BYTES = 64 << 20 # output text kept in memory by a PrefixCache
+
+def build_cycle(divisors: dict) -> list | None:
+    # The output repeats every lcm(divisors) numbers: cycle[k] holds the words
+    # for every i with (i - 1) % period == k, or "" where the number is printed
+    period = math.lcm(*divisors)
+    if not 0 < period <= MAX_CYCLE:
+        return None
+    cycle = [""] * period
+    for divisor, word in divisors.items():
+        for k in range(abs(divisor) - 1, period, abs(divisor)):
+            cycle[k] += word
+    return cycle
+
+def build_template(cycle: list, block_size: int, digits: int) -> list:
+    # Lays out block_size lines following the cycle. Each number i = base + k
+    # (base being a multiple of the block size) is written as its leading part
+    # base // unit + k // unit, followed by its trailing digits k % unit which
+    # are baked into the template once for all. Lines sharing the same leading
+    # part form a segment, stored as the literal parts around its numbers
+    unit = 10 ** digits
+    period = len(cycle)
+    # Mark where the leading parts go and where segments start, distinct
+    # from any word and from each other
+    marker, boundary = "\0", "\1"
+    while any(marker in word or boundary in word for word in cycle):
+        marker, boundary = marker + "\0", boundary + "\1"
+    tails = [marker + (f"{k:0{digits}d}" if digits else "") for k in range(unit)]
+    tails = (tails[1:] + tails[:1]) * (block_size // unit)
+    lines = [word or tail for word, tail in zip(cycle * (block_size // period), tails)]
+    for k in range(max(2, unit), block_size+1, unit):
+        lines[k-1] = boundary + lines[k-1]
+    segments = "\n".join(lines).split(boundary)
+    return [(high, tuple(text.split(marker))) for high, text in enumerate(segments, 1 // unit)]
+
+def stamp_template(template: list, block_size: int, digits: int, base: int, lo: int, hi: int) -> str:
+    # Renders the numbers lo..hi of the block following base from its
+    # template, stamping only the segments they span. base must be above 0,
+    # as the leading parts of the first block would start with a 0
+    unit, first = 10 ** digits, template[0][0]
+    segments = template[(lo - base) // unit - first:(hi - base) // unit - first + 1]
+    text = "".join(str(base // unit + high).join(parts) for high, parts in segments)
+    # The first and last segments may hold lines outside lo..hi, and all
+    # segments but the last end with a line break
+    k_first = max(1, segments[0][0] * unit)
+    k_last = min(segments[-1][0] * unit + unit - 1, block_size)
+    skip, drop = lo - base - k_first, k_last - (hi - base)
+    if k_last < block_size:
+        text = text[:-1]
+    if skip:
+        text = text.split("\n", skip)[skip]
+    if drop:
+        text = text.rsplit("\n", drop)[0]
+    return text
+
+def iter_modulo(n: int, divisors: dict, start: int = 1) -> Iterator[str]:
+    for i in range(start, n+1):
         res = ""
         for divisor, word in divisors.items():
             if i % divisor == 0:
                 res += word
-        result.append(res or str(i))
-    return result
+        yield res or str(i)
+
+def iter_fizzbuzz(n: int, divisors: dict) -> Iterator[str]:
+    cycle = build_cycle(divisors)
+    if cycle is None:
+        yield from iter_modulo(n, divisors)
+        return
+    period = len(cycle)
+    for base in range(0, n, period):
+        for i, word in enumerate(cycle[:n - base], base + 1):
+            yield word or str(i)
+
+def iter_modulo_blocks(n: int, divisors: dict, start: int = 1) -> Iterator[str]:
+    lines = iter_modulo(n, divisors, start)
+    while chunk := list(islice(lines, CHUNK_SIZE)):
+        yield "\n".join(chunk)
+
+def iter_blocks(n: int, divisors: dict, start: int = 1) -> Iterator[str]:
+    # Yields "\n"-joined blocks of at least CHUNK_SIZE lines for start..n,
+    # produced by stamping the numbers into a precomputed template
+    cycle = build_cycle(divisors)
+    if cycle is None:
+        yield from iter_modulo_blocks(n, divisors, start)
+        return
+    period = len(cycle)
+    # Each trailing digit baked into the template divides the leading parts to
+    # stamp by 10, but multiplies the template span. The span may grow with the
+    # lines to render, up to TEMPLATE_CHUNKS chunks, so that building the
+    # template stays a fraction of the work
+    largest = max(CHUNK_SIZE, period, min((n - start + 1) // 8, TEMPLATE_CHUNKS * CHUNK_SIZE))
+    for digits in range(STAMP_DIGITS, -1, -1):
+        span = math.lcm(period, 10 ** digits)
+        if span <= largest:
+            break
+    block_size = max(1, CHUNK_SIZE // span) * span
+    unit = 10 ** digits
+    template = None
+    for base in range((start - 1) // block_size * block_size, n, block_size):
+        lo, hi = max(base + 1, start), min(base + block_size, n)
+        blocks = []
+        if base == 0:
+            # Numbers below unit have fewer digits than the template expects
+            blocks.append("\n".join(cycle[(i - 1) % period] or str(i) for i in range(lo, min(hi, unit - 1) + 1)))
+            lo = max(lo, unit)
+        if lo <= hi:
+            if template is None:
+                template = build_template(cycle, block_size, digits)
+                # The template leading parts are consecutive
+                segment_parts = [parts for _, parts in template]
+            lead = base // unit + template[0][0]
+            if lo == base + 1 and hi == base + block_size:
+                blocks.append("".join(map(str.join, map(str, range(lead, lead + len(template))), segment_parts)))
+            else:
+                blocks.append(stamp_template(template, block_size, digits, base, lo, hi))
+        yield "\n".join(block for block in blocks if block)
+
+def iter_numpy_blocks(n: int, divisors: dict, start: int = 1) -> Iterator[str]:
+    # Divisibility of a whole block is computed at once: each number gets a
+    # bit mask of the divisors it matches, and every distinct mask is turned
+    # into its words only once per block
+    if any(divisor == 0 or abs(divisor) >= 2 ** 63 for divisor in divisors) or len(divisors) > 62:
+        yield from iter_modulo_blocks(n, divisors, start)
+        return
+    words = list(divisors.values())
+    for lo in range(start, n+1, CHUNK_SIZE):
+        numbers = np.arange(lo, min(lo + CHUNK_SIZE, n + 1), dtype=np.int64)
+        masks = np.zeros(len(numbers), dtype=np.int64)
+        for bit, divisor in enumerate(divisors):
+            masks |= (numbers % divisor == 0).astype(np.int64) << bit
+        uniques, inverse = np.unique(masks, return_inverse=True)
+        table = ["".join(word for bit, word in enumerate(words) if mask >> bit & 1) for mask in uniques.tolist()]
+        lines = np.array(table, dtype=object)[inverse]
+        numeric = np.array([not word for word in table])[inverse]
+        lines[numeric] = numbers[numeric].astype(str)
+        yield "\n".join(lines.tolist())
+
+ENGINES = {"modulo": iter_modulo_blocks, "cycle": iter_blocks}
+if np is not None:
+    ENGINES["numpy"] = iter_numpy_blocks
+DEFAULT_ENGINE = "cycle"
+
+DEFAULT_DIVISORS = {3: "Fizz", 5: "Buzz"}
 
-def write_to_file(n: int, results: list):
-    os.makedirs(output_dir, exist_ok=True)
-    file_path = os.path.join(output_dir, f"{n}.txt")
+# name: (head, separator between blocks, tail, block encoder)
+FORMATS = {
+    "txt": ("", "\n", "", lambda block: block),
+    "json": ("[", ", ", "]", lambda block: json.dumps(block.split("\n"))[1:-1]),
+}
+DEFAULT_FORMAT = "txt"
+
+def fizzbuzz(n: int, divisors: dict) -> list:
+    return list(iter_fizzbuzz(n, divisors))
+
+def output_path(n: int, directory: str | None = None, fmt: str = DEFAULT_FORMAT) -> str:
+    return os.path.join(directory or output_dir, f"{n}.{fmt}")
+
+def dump_blocks(file_path: str, blocks: Iterable[str], fmt: str = DEFAULT_FORMAT, framed: bool = True) -> str:
+    # framed=False leaves out the format head and tail, for shard parts
+    head, separator, tail, encode = FORMATS[fmt]
     with open(file_path, 'w') as f:
-        f.write("\n".join(results))
+        f.write(head if framed else "")
+        for index, block in enumerate(blocks):
+            f.write((separator if index else "") + encode(block))
+        f.write(tail if framed else "")
+    return file_path
+
+def write_blocks(n: int, blocks: Iterable[str], directory: str | None = None, fmt: str = DEFAULT_FORMAT) -> str:
+    os.makedirs(directory or output_dir, exist_ok=True)
+    return dump_blocks(output_path(n, directory, fmt), blocks, fmt)
+
+def write_shard(shard: tuple) -> str:
+    start, stop, divisors, engine, fmt, part_path = shard
+    return dump_blocks(part_path, ENGINES[engine](stop, divisors, start), fmt, framed=False)
 
-def process_number(n: int, divisors: dict) -> list | ValueError:
+def write_parallel(n: int, divisors: dict, engine: str = DEFAULT_ENGINE, workers: int = WORKERS, shard_size: int = SHARD_SIZE,
+                   directory: str | None = None, fmt: str = DEFAULT_FORMAT) -> str:
+    # Every shard is rendered to its own part file by the pool, parts are then
+    # appended to the output in order as soon as they are ready
+    os.makedirs(directory or output_dir, exist_ok=True)
+    file_path = output_path(n, directory, fmt)
+    head, separator, tail, _ = FORMATS[fmt]
+    shards = [
+        (start, min(start + shard_size - 1, n), divisors, engine, fmt, f"{file_path}.part{index}")
+        for index, start in enumerate(range(1, n+1, shard_size))
+    ]
+    with ProcessPoolExecutor(max_workers=workers) as executor, open(file_path, 'wb') as f:
+        f.write(head.encode())
+        for index, part_path in enumerate(executor.map(write_shard, shards)):
+            if index:
+                f.write(separator.encode())
+            with open(part_path, 'rb') as part:
+                shutil.copyfileobj(part, f, 1 << 20)
+            os.remove(part_path)
+        f.write(tail.encode())
+    return file_path
+
+def write_to_file(n: int, results: Iterable[str], directory: str | None = None, fmt: str = DEFAULT_FORMAT) -> str:
+    lines = iter(results)
+    return write_blocks(n, ("\n".join(chunk) for chunk in iter(lambda: list(islice(lines, CHUNK_SIZE)), [])), directory, fmt)
+
+def check_options(n: int, engine: str = DEFAULT_ENGINE, fmt: str = DEFAULT_FORMAT) -> int:
+    n = int(n)
+    if n < 1:
+        raise ValueError("Number must be greater than 0")
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown engine '{engine}', expected one of: {', '.join(ENGINES)}")
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown format '{fmt}', expected one of: {', '.join(FORMATS)}")
+    return n
+
+def export(n: int, divisors: dict = DEFAULT_DIVISORS, *, directory: str | None = None, fmt: str = DEFAULT_FORMAT,
+           engine: str = DEFAULT_ENGINE, workers: int = WORKERS, shard_size: int = SHARD_SIZE) -> str:
+    # Library entry point: writes the results for n and returns the file path,
+    # without printing anything. Invalid arguments raise ValueError
+    n = check_options(n, engine, fmt)
+    if workers > 1 and n > shard_size:
+        return write_parallel(n, divisors, engine, workers, shard_size, directory, fmt)
+    return write_blocks(n, ENGINES[engine](n, divisors), directory, fmt)
+
+def export_many(numbers: Iterable[int], divisors: dict = DEFAULT_DIVISORS, cache: "PrefixCache | None" = None, **options) -> dict:
+    exporter = export if cache is None else cache.export
+    return {n: exporter(n, divisors, **options) for n in numbers}
+
+def file_signature(file_path: str) -> tuple | None:
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+def copy_lines(source: str, file_path: str, n: int) -> str:
+    # Copies the first n lines of source, without the final line break
+    with open(source, 'rb') as src, open(file_path, 'wb') as dst:
+        while n and (chunk := src.read(1 << 20)):
+            parts = chunk.split(b"\n", n)
+            if len(parts) > n:
+                chunk = chunk[:len(chunk) - len(parts[-1]) - 1]
+            n -= len(parts) - 1
+            dst.write(chunk)
+    return file_path
+
+class PrefixCache:
+    # The output for n is a prefix of the output for any larger n with the same
+    # rules, so only the largest result is kept per rule set: its blocks while
+    # they fit in max_bytes (least recently used rule sets are evicted first),
+    # otherwise the file it was exported to. Smaller n are sliced or copied
+    # from it, larger n only render the missing lines. Only the txt format is
+    # cached, other formats go through export()
+    def __init__(self, max_bytes: int = CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict() # rules -> {"n", "blocks", "ends", "size", "path"}
+        self.files = {} # exported path -> (rules, n, signature)
+
+    def entry(self, divisors: dict) -> dict:
+        key = tuple(divisors.items())
+        if key not in self.entries:
+            self.entries[key] = {"n": 0, "blocks": [], "ends": [], "size": 0, "path": None}
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def evict(self) -> None:
+        for key, entry in list(self.entries.items()):
+            if self.size <= self.max_bytes:
+                break
+            if entry["blocks"] is not None:
+                self.size -= entry["size"]
+                entry.update(blocks=None, ends=None, size=0)
+            if entry["path"] is None:
+                del self.entries[key]
+
+    def extend(self, entry: dict, n: int, divisors: dict, engine: str) -> None:
+        for block in ENGINES[engine](n, divisors, entry["n"] + 1):
+            entry["blocks"].append(block)
+            entry["ends"].append((entry["ends"][-1] if entry["ends"] else 0) + block.count("\n") + 1)
+            entry["size"] += len(block) + 1
+            self.size += len(block) + 1
+        entry["n"] = n
+        self.evict()
+
+    def prefix(self, entry: dict, n: int) -> Iterator[str]:
+        last = bisect_left(entry["ends"], n)
+        yield from entry["blocks"][:last]
+        head = n - (entry["ends"][last - 1] if last else 0)
+        if head:
+            yield "\n".join(entry["blocks"][last].split("\n", head)[:head])
+
+    def in_memory(self, entry: dict, n: int) -> bool:
+        if entry["blocks"] is None:
+            return False
+        # upper bound of the text size for number-only lines
+        return n <= entry["n"] or n * (len(str(n)) + 1) <= self.max_bytes
+
+    def text(self, n: int, divisors: dict = DEFAULT_DIVISORS, engine: str = DEFAULT_ENGINE) -> str:
+        n = check_options(n, engine)
+        entry = self.entry(divisors)
+        if not self.in_memory(entry, n):
+            return "\n".join(ENGINES[engine](n, divisors))
+        if n > entry["n"]:
+            self.extend(entry, n, divisors, engine)
+            if entry["blocks"] is None:
+                return "\n".join(ENGINES[engine](n, divisors))
+        return "\n".join(self.prefix(entry, n))
+
+    def export(self, n: int, divisors: dict = DEFAULT_DIVISORS, *, directory: str | None = None, fmt: str = DEFAULT_FORMAT,
+               engine: str = DEFAULT_ENGINE, workers: int = WORKERS, shard_size: int = SHARD_SIZE) -> str:
+        n = check_options(n, engine, fmt)
+        if fmt != "txt":
+            return export(n, divisors, directory=directory, fmt=fmt, engine=engine, workers=workers, shard_size=shard_size)
+        key, entry = tuple(divisors.items()), self.entry(divisors)
+        file_path = output_path(n, directory, fmt)
+        known = self.files.get(file_path)
+        if known and known[:2] == (key, n) and known[2] == file_signature(file_path):
+            return file_path
+
+        if self.in_memory(entry, n):
+            if n > entry["n"]:
+                self.extend(entry, n, divisors, engine)
+            if entry["blocks"] is not None:
+                write_blocks(n, self.prefix(entry, n), directory, fmt)
+                return self.record(key, n, file_path)
+
+        source = entry["path"]
+        # Another rule set or n may have been exported to the same path since
+        if source is None or self.files.get(source) != (key, entry["n"], file_signature(source)):
+            source = entry["path"] = None
+        os.makedirs(directory or output_dir, exist_ok=True)
+        if source is not None and n <= entry["n"]:
+            copy_lines(source, file_path, n)
+        elif source is not None:
+            shutil.copyfile(source, file_path)
+            with open(file_path, 'a') as f:
+                for block in ENGINES[engine](n, divisors, entry["n"] + 1):
+                    f.write("\n" + block)
+        else:
+            export(n, divisors, directory=directory, fmt=fmt, engine=engine, workers=workers, shard_size=shard_size)
+        if n >= entry["n"] or source is None:
+            entry.update(n=n, path=file_path)
+            self.entries[key] = entry
+            if entry["blocks"] is not None:
+                self.size -= entry["size"]
+                entry.update(blocks=None, ends=None, size=0)
+        return self.record(key, n, file_path)
+
+    def record(self, key: tuple, n: int, file_path: str) -> str:
+        self.files[file_path] = (key, n, file_signature(file_path))
+        return file_path
+
+def process_number(n: int, divisors: dict, engine: str = DEFAULT_ENGINE, workers: int = WORKERS, shard_size: int = SHARD_SIZE,
+                   cache: PrefixCache | None = None) -> list | str | ValueError:
     try:
         n = int(n)
         if n < 1:
             raise ValueError("Number must be greater than 0")
-        results = fizzbuzz(n, divisors)
+        if n > ECHO_LIMIT:
+            exporter = export if cache is None else cache.export
+            file_path = exporter(n, divisors, engine=engine, workers=workers, shard_size=shard_size)
+            print(f"> Results for {n} exported in Algo/output/{n}.txt (not displayed, above {ECHO_LIMIT})\n")
+            return file_path
+        results = fizzbuzz(n, divisors) if cache is None else cache.text(n, divisors, engine).split("\n")
         write_to_file(n, results)
         print(f"> Results for {n} exported in Algo/output/{n}.txt")
         print("\n".join(results), "\n")
@@ -45,29 +401,73 @@ def parse_divisors(input_string: str) -> dict | None:
             print(f"Skipping invalid rule: {rule}")
     return divisors
 
-if "-h" in sys.argv or "--help" in sys.argv or len(sys.argv) > 1:
-    help_message = """Usage: python fizzbuzz.py
+def parse_numbers(value: str) -> range:
+    # "15" or an inclusive range "1-100"
+    try:
+        start, _, stop = value.partition("-")
+        numbers = range(int(start), int(stop or start) + 1)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid number or range: '{value}'")
+    if not numbers or numbers.start < 1:
+        raise argparse.ArgumentTypeError(f"numbers must be greater than 0: '{value}'")
+    return numbers
+
+def interactive(divisors: dict | None, **options) -> None:
+    if divisors is None:
+        divisor_inputs = input("Enter divisor rules (by default: 3:Fizz 5:Buzz): ")
+        divisors = parse_divisors(divisor_inputs) if divisor_inputs else DEFAULT_DIVISORS
+        if not divisors:
+            exit(ValueError("No valid divisor rule found"))
+
+    cache = PrefixCache()
+    while True:
+        try:
+            number = input("Enter a number: ")
+        except (EOFError, KeyboardInterrupt):
+            print()
+            return
+        if not number:
+            print("Please enter a valid number")
+            continue
+
+        process_number(number, divisors, cache=cache, **options)
 
-    Example:
+def main(argv: list | None = None) -> int:
+    parser = argparse.ArgumentParser(
+        description="Display numbers between 1 and N following divisor rules. Without numbers, starts the interactive mode.",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""Example:
     python3 Algo/fizzbuzz.py
     > Enter divisor rules (by default: 3:Fizz 5:Buzz): 3:Fizz 5:Buzz 7:Woof
     > Enter a number: 15
-    """
-    print(help_message)
-    exit(0)
-
-divisor_inputs = input("Enter divisor rules (by default: 3:Fizz 5:Buzz): ")
-if not divisor_inputs:
-    divisors = {3: "Fizz", 5: "Buzz"}
-else:
-    divisors = parse_divisors(divisor_inputs)
-    if not divisors:
-        exit(ValueError("No valid divisor rule found"))
-
-while True:
-    number = input("Enter a number: ")
-    if not number:
-        print("Please enter a valid number")
-        continue
-
-    process_number(number, divisors)
+
+    python3 Algo/fizzbuzz.py --rules "3:Fizz 5:Buzz 7:Woof" --format json 15 100-105
+""")
+    parser.add_argument("numbers", nargs="*", type=parse_numbers, help="numbers or inclusive ranges (e.g. 15 1-100) to export")
+    parser.add_argument("-r", "--rules", help="divisor rules (by default: 3:Fizz 5:Buzz)")
+    parser.add_argument("-o", "--output-dir", default=output_dir, help="directory receiving the {n}.{format} files")
+    parser.add_argument("-f", "--format", default=DEFAULT_FORMAT, choices=FORMATS)
+    parser.add_argument("-e", "--engine", default=DEFAULT_ENGINE, choices=ENGINES)
+    parser.add_argument("-w", "--workers", type=int, default=WORKERS, help="processes used for ranges above --shard-size")
+    parser.add_argument("-s", "--shard-size", type=int, default=SHARD_SIZE, help="lines rendered per worker task")
+    args = parser.parse_args(argv)
+
+    divisors = None
+    if args.rules is not None:
+        divisors = parse_divisors(args.rules)
+        if not divisors:
+            parser.error("No valid divisor rule found")
+
+    if not args.numbers:
+        interactive(divisors, engine=args.engine, workers=args.workers, shard_size=args.shard_size)
+        return 0
+
+    options = dict(directory=args.output_dir, fmt=args.format, engine=args.engine, workers=args.workers, shard_size=args.shard_size)
+    cache = PrefixCache()
+    for numbers in args.numbers:
+        for file_path in export_many(numbers, divisors or DEFAULT_DIVISORS, cache, **options).values():
+            print(file_path)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
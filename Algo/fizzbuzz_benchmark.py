@@ -0,0 +1,129 @@
+# Benchmark of the fizzbuzz engines
+import argparse, json, multiprocessing, os, platform, resource, sys, tempfile, time
+
+import fizzbuzz
+
+RULE_SETS = {
+    "default": "3:Fizz 5:Buzz",
+    "many": "3:Fizz 5:Buzz 7:Woof 11:Bar 13:Baz",
+    "coprime": "7:Foo 11:Bar 13:Baz 17:Qux 19:Quux 23:Corge",
+}
+THROUGHPUT_RULES = ["default", "many"] # rule sets compared at a single large n
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux, in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1 << 20) if sys.platform == "darwin" else peak / (1 << 10)
+
+def run_case(engine: str, rules: str, n: int, connection) -> None:
+    # Runs in its own process so that the peak RSS only belongs to this case
+    divisors = fizzbuzz.parse_divisors(rules)
+    baseline_rss = peak_rss_mb()
+    with tempfile.TemporaryDirectory() as directory:
+        start = time.perf_counter()
+        if engine == "lines":
+            size = sum(len(line) + 1 for line in fizzbuzz.iter_fizzbuzz(n, divisors)) - 1
+        else:
+            size = sum(len(block) + 1 for block in fizzbuzz.ENGINES[engine](n, divisors)) - 1
+        generate_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        if engine == "lines":
+            file_path = fizzbuzz.write_to_file(n, fizzbuzz.iter_fizzbuzz(n, divisors), directory)
+        else:
+            file_path = fizzbuzz.write_blocks(n, fizzbuzz.ENGINES[engine](n, divisors), directory)
+        write_seconds = time.perf_counter() - start
+        assert os.path.getsize(file_path) == size
+
+    connection.send({
+        "lines": n,
+        "bytes": size,
+        "generate_seconds": generate_seconds,
+        "lines_per_second": n / generate_seconds,
+        "mb_per_second": size / (1 << 20) / generate_seconds,
+        "write_seconds": write_seconds,
+        "write_mb_per_second": size / (1 << 20) / write_seconds,
+        "peak_rss_mb": peak_rss_mb(),
+        "rss_delta_mb": peak_rss_mb() - baseline_rss,
+    })
+
+def benchmark(engine: str, rules: str, n: int, timeout: float) -> dict:
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(target=run_case, args=(engine, rules, n, sender))
+    process.start()
+    # Only the child keeps the sending end open, so its exit wakes up poll()
+    sender.close()
+    result = {"status": "timeout"}
+    if receiver.poll(timeout):
+        try:
+            result = {"status": "ok", **receiver.recv()}
+        except EOFError:
+            process.join()
+            result = {"status": "error", "exitcode": process.exitcode}
+    process.terminate()
+    process.join()
+    return result
+
+def throughput(engines: list, rules: str, n: int, timeout: float) -> dict:
+    # Lines per second of each engine at a single n, and its speedup over the
+    # per-number modulo loop
+    case = {"rules": rules, "divisors": RULE_SETS[rules], "n": n}
+    results = {engine: benchmark(engine, RULE_SETS[rules], n, timeout) for engine in dict.fromkeys(["modulo", *engines])}
+    baseline = results["modulo"].get("lines_per_second")
+    for engine in engines:
+        result = results[engine]
+        case[engine] = {"status": result["status"], "lines_per_second": result.get("lines_per_second")}
+        if baseline and result["status"] == "ok":
+            case[engine]["speedup"] = result["lines_per_second"] / baseline
+    return case
+
+def main(argv: list | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark fizzbuzz engines, results are printed as JSON.")
+    parser.add_argument("-e", "--engines", nargs="+", default=["lines", *fizzbuzz.ENGINES], choices=["lines", *fizzbuzz.ENGINES],
+                        help="engines to measure, 'lines' being iter_fizzbuzz with write_to_file")
+    parser.add_argument("-r", "--rules", nargs="+", default=list(RULE_SETS), choices=RULE_SETS)
+    parser.add_argument("--min-exponent", type=int, default=3, help="smallest n as a power of 10")
+    parser.add_argument("--max-exponent", type=int, default=7, help="largest n as a power of 10 (up to 9)")
+    parser.add_argument("--throughput-lines", type=int, default=3 * 10 ** 6,
+                        help="n of the throughput cases, comparing the engines to 'modulo' on the default and many rule sets (0 to skip)")
+    parser.add_argument("-t", "--timeout", type=float, default=300, help="seconds before a case is abandoned")
+    parser.add_argument("-o", "--output", help="JSON file to write instead of stdout")
+    args = parser.parse_args(argv)
+
+    results = []
+    for rules in args.rules:
+        for engine in args.engines:
+            timed_out = False
+            for exponent in range(args.min_exponent, args.max_exponent + 1):
+                case = {"engine": engine, "rules": rules, "divisors": RULE_SETS[rules], "n": 10 ** exponent}
+                # Larger n would time out as well
+                result = {"status": "skipped"} if timed_out else benchmark(engine, RULE_SETS[rules], 10 ** exponent, args.timeout)
+                timed_out = result["status"] != "ok"
+                results.append({**case, **result})
+                print(json.dumps(results[-1]), file=sys.stderr)
+
+    # Many divisors make a longer cycle, hence a larger template to build
+    throughputs = []
+    if args.throughput_lines:
+        for rules in THROUGHPUT_RULES:
+            throughputs.append(throughput(args.engines, rules, args.throughput_lines, args.timeout))
+            print(json.dumps(throughputs[-1]), file=sys.stderr)
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "chunk_size": fizzbuzz.CHUNK_SIZE,
+        "results": results,
+        "throughput": throughputs,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,168 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import fizzbuzz
+import fizzbuzz_benchmark
+
+RULE_SETS = [
+    {3: "Fizz", 5: "Buzz"},
+    {3: "Fizz", 5: "Buzz", 7: "Woof", 11: "Bar", 13: "Baz"},
+    {255: "A", 256: "B"}, # lcm of 65280, a single block
+    {3: "Fizz", 65537: "Big"}, # lcm above MAX_CYCLE, modulo fallback
+    {-3: "Fizz", 5: "Buzz"},
+    {1: "All", 2: "Even"},
+    {1: ""},
+]
+
+
+def reference(n: int, divisors: dict, start: int = 1) -> str:
+    return "\n".join(fizzbuzz.iter_modulo(n, divisors, start))
+
+
+class EngineTest(unittest.TestCase):
+    # Every engine must produce the same bytes as the plain modulo loop
+
+    def assert_engines(self, n: int, divisors: dict, start: int = 1, expected: str | None = None):
+        expected = reference(n, divisors, start) if expected is None else expected
+        for engine, blocks in fizzbuzz.ENGINES.items():
+            self.assertEqual("\n".join(blocks(n, divisors, start)), expected, (engine, divisors, n, start))
+
+    def test_fizzbuzz(self):
+        self.assertEqual(fizzbuzz.fizzbuzz(15, fizzbuzz.DEFAULT_DIVISORS)[-3:], ["13", "14", "FizzBuzz"])
+        for divisors in RULE_SETS:
+            self.assertEqual("\n".join(fizzbuzz.fizzbuzz(500, divisors)), reference(500, divisors))
+
+    def test_engines_block_edges(self):
+        # Small blocks, so that the full blocks, their edges and the number
+        # length changes (10, 100, 1000) are all reached with few lines. The
+        # 65280 lines cycle is left to test_engines_full_chunks
+        with mock.patch.object(fizzbuzz, "CHUNK_SIZE", 50):
+            for divisors in RULE_SETS[:2] + RULE_SETS[3:]:
+                lines = reference(1200, divisors).split("\n")
+                numbers = [1, 2, 3, 14, 15, 16, 29, 30, 31, 49, 50, 51, 99, 100, 101, 999, 1000, 1001, 1200]
+                for n in sorted(set(numbers + list(range(5, 1200, 37)))):
+                    self.assert_engines(n, divisors, expected="\n".join(lines[:n]))
+                for start in [2, 16, 30, 31, 51, 100, 101, 1000]:
+                    self.assert_engines(1200, divisors, start, "\n".join(lines[start - 1:]))
+                    self.assert_engines(start, divisors, start, lines[start - 1])
+
+    def test_engines_large_templates(self):
+        # Enough lines for templates spanning several blocks of 50 lines, with
+        # two trailing digits baked in, and partial blocks stamped from them
+        with mock.patch.object(fizzbuzz, "CHUNK_SIZE", 50):
+            for divisors in [RULE_SETS[0], RULE_SETS[4], RULE_SETS[5]]:
+                lines = reference(5000, divisors).split("\n")
+                for n in [2400, 2401, 2999, 3000, 3001, 5000]:
+                    self.assert_engines(n, divisors, expected="\n".join(lines[:n]))
+                for start in [2, 99, 100, 101, 301, 2999]:
+                    self.assert_engines(5000, divisors, start, "\n".join(lines[start - 1:]))
+
+    def test_engines_full_chunks(self):
+        size = fizzbuzz.CHUNK_SIZE
+        for divisors in RULE_SETS[:3]:
+            for n in [size - 1, size, size + 1, 2 * size + 7]:
+                self.assert_engines(n, divisors)
+            self.assert_engines(2 * size + 7, divisors, size - 3)
+
+
+class ExportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def read(self, file_path: str) -> str:
+        with open(file_path) as f:
+            return f.read()
+
+    def test_write_parallel(self):
+        for divisors in RULE_SETS[:2] + RULE_SETS[4:]:
+            for n in [1, 36, 37, 38, 500]:
+                file_path = fizzbuzz.write_parallel(n, divisors, "cycle", workers=2, shard_size=37, directory=self.directory.name)
+                self.assertEqual(self.read(file_path), reference(n, divisors), (divisors, n))
+                self.assertEqual(os.listdir(self.directory.name), [f"{n}.txt"])
+                os.remove(file_path)
+
+        file_path = fizzbuzz.write_parallel(500, fizzbuzz.DEFAULT_DIVISORS, "modulo", workers=2, shard_size=37, directory=self.directory.name, fmt="json")
+        self.assertEqual(json.loads(self.read(file_path)), fizzbuzz.fizzbuzz(500, fizzbuzz.DEFAULT_DIVISORS))
+
+    def test_export(self):
+        file_path = fizzbuzz.export(100, directory=self.directory.name, workers=2, shard_size=30)
+        self.assertEqual(self.read(file_path), reference(100, fizzbuzz.DEFAULT_DIVISORS))
+        with self.assertRaises(ValueError):
+            fizzbuzz.export(0, directory=self.directory.name)
+
+
+class PrefixCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_export(self):
+        cache = fizzbuzz.PrefixCache(max_bytes=1000)
+        for n in [3000, 100, 5000, 4000]:
+            with open(cache.export(n, directory=self.directory.name, workers=1)) as f:
+                self.assertEqual(f.read(), reference(n, fizzbuzz.DEFAULT_DIVISORS), n)
+
+    def test_export_shared_path(self):
+        # Both rule sets export to 300000.txt, the second one overwriting the
+        # file the first one would otherwise copy its smaller n from
+        cache = fizzbuzz.PrefixCache(max_bytes=1000)
+        other = {2: "a", 7: "b"}
+        cache.export(300000, directory=self.directory.name, workers=1)
+        cache.export(300000, other, directory=self.directory.name, workers=1)
+        for n, divisors in [(2000, fizzbuzz.DEFAULT_DIVISORS), (1000, other)]:
+            with open(cache.export(n, divisors, directory=self.directory.name, workers=1)) as f:
+                self.assertEqual(f.read(), reference(n, divisors), divisors)
+
+    def test_export_other_directory(self):
+        # The smaller n is copied from the file exported to the first directory
+        cache = fizzbuzz.PrefixCache(max_bytes=1000)
+        first, second = os.path.join(self.directory.name, "a"), os.path.join(self.directory.name, "b")
+        cache.export(5000, directory=first, workers=1)
+        with open(cache.export(3000, directory=second, workers=1)) as f:
+            self.assertEqual(f.read(), reference(3000, fizzbuzz.DEFAULT_DIVISORS))
+        self.assertEqual(os.listdir(second), ["3000.txt"])
+
+    def test_text_bounded(self):
+        cache = fizzbuzz.PrefixCache(max_bytes=1000)
+        self.assertEqual(cache.text(100), reference(100, fizzbuzz.DEFAULT_DIVISORS))
+        with mock.patch.object(cache, "extend", wraps=cache.extend) as extend:
+            self.assertEqual(cache.text(100000), reference(100000, fizzbuzz.DEFAULT_DIVISORS))
+            extend.assert_not_called()
+        self.assertLessEqual(cache.size, cache.max_bytes)
+        self.assertEqual(cache.text(50), reference(50, fizzbuzz.DEFAULT_DIVISORS))
+
+
+class BenchmarkTest(unittest.TestCase):
+
+    def test_benchmark(self):
+        result = fizzbuzz_benchmark.benchmark("cycle", "3:Fizz 5:Buzz", 1000, timeout=60)
+        self.assertEqual((result["status"], result["lines"]), ("ok", 1000))
+
+    def test_throughput(self):
+        case = fizzbuzz_benchmark.throughput(["cycle"], "many", 1000, timeout=60)
+        self.assertEqual((case["n"], case["cycle"]["status"]), (1000, "ok"))
+        self.assertGreater(case["cycle"]["speedup"], 0)
+        self.assertNotIn("modulo", case)
+
+    def test_benchmark_crash(self):
+        def crash(n, divisors, start=1):
+            raise MemoryError
+
+        # A crashed case is reported at once, not after the timeout
+        with mock.patch.dict(fizzbuzz.ENGINES, {"crash": crash}), mock.patch("sys.stderr"):
+            result = fizzbuzz_benchmark.benchmark("crash", "3:Fizz", 1000, timeout=60)
+        self.assertEqual(result, {"status": "error", "exitcode": 1})
+
+
+if __name__ == "__main__":
+    unittest.main()
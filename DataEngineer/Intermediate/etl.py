@@ -1,42 +1,1051 @@
 import pandas as pd
+import numpy as np
 import sqlite3
-from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from abc import ABC, abstractmethod
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime, timezone
+import argparse
+import hashlib
+import itertools
 import glob
+import json
 import os
+import queue
+import re
+import signal
+import sys
+import time
 
-# Extract
-csv_files = glob.glob(os.path.join("./", "*.csv"))
+try:
+    import psycopg
+except ImportError:
+    psycopg = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+    import pyarrow.fs
+except ImportError:
+    # Without pyarrow, transactions can't be archived
+    pa = pc = ds = None
+
+DATABASE = 'retail.db'
+DATABASE_URL_VARIABLE = 'RETAIL_DATABASE_URL' # overrides DATABASE, e.g. postgresql://user@host/retail
+POOL_SIZE = 4 # idle connections kept by a backend
+DROP_DIRECTORY = './'
+CHUNK_ROWS = 50_000 # CSV rows read, transformed and inserted at once
+SYNCHRONOUS = 'NORMAL' # safe with WAL: a crash may only lose the last commits
+CACHE_SIZE_KIB = 64 * 1024 # SQLite page cache
+SYNCHRONOUS_LEVELS = ['OFF', 'NORMAL', 'FULL', 'EXTRA']
+WORKERS = os.cpu_count() or 1
+BATCH_ROWS = 200_000 # rows committed at once by the parallel writer
+POLL_INTERVAL = 1.0 # seconds between two scans of the drop directory in watch mode
+BATCH_WINDOW = 2.0 # seconds a micro-batch waits for more files once one is ready
+CATEGORIES = ['SELL', 'BUY']
+TAX_RATE = 0.2
+TAX_TOLERANCE = 0.01 # amount_inc_tax is rounded to the cent
+COLUMNS = ['id', 'transaction_date', 'category', 'name', 'quantity', 'amount_excl_tax', 'amount_inc_tax']
+FILE_PATTERN = re.compile(r"retail_(\d{2})_(\d{2})_(\d{4})\.csv")
+
+
+def file_date(csv_file: str) -> str:
+    """Returns the transaction date of a retail_DD_MM_YYYY.csv file as 'YYYY-MM-DD'."""
+    match = FILE_PATTERN.fullmatch(os.path.basename(csv_file))
+    if not match:
+        raise ValueError(f"{csv_file} doesn't match retail_DD_MM_YYYY.csv")
+    day, month, year = match.groups()
+    return datetime(int(year), int(month), int(day)).strftime("%Y-%m-%d")
+
+
+def file_sha256(csv_file: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(csv_file, 'rb') as f:
+        while chunk := f.read(1 << 20):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def connect(database: str = DATABASE, synchronous: str = SYNCHRONOUS, cache_size_kib: int = CACHE_SIZE_KIB) -> sqlite3.Connection:
+    """Opens the database in WAL mode, with the given synchronous level and page cache size."""
+    if synchronous.upper() not in SYNCHRONOUS_LEVELS:
+        raise ValueError(f"synchronous must be one of {', '.join(SYNCHRONOUS_LEVELS)}")
+    conn = sqlite3.connect(database)
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute(f"PRAGMA synchronous = {synchronous.upper()}")
+    conn.execute(f"PRAGMA cache_size = {-int(cache_size_kib)}")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    return conn
 
-if not csv_files:
-    raise FileNotFoundError("Aucun fichier CSV trouvé dans le répertoire spécifié.")
 
-latest_csv_file = max(csv_files, key=os.path.getmtime)
-print(f"Le dernier fichier CSV créé est: {latest_csv_file}")
+# Extract
+def extract_chunks(csv_file: str, chunk_rows: int = CHUNK_ROWS):
+    """Reads the CSV file lazily, chunk_rows rows at a time."""
+    with pd.read_csv(csv_file, chunksize=chunk_rows) as reader:
+        yield from reader
 
-date_str = latest_csv_file.replace("retail_", "").replace(".csv", "")
-csv_file = 'retail_15_01_2022.csv'
-df = pd.read_csv(csv_file)
-print("Extraction completed!")
 
 # Transform
-df.rename(columns={'description': 'name'}, inplace=True)
-df["transaction_date"] = datetime.strptime(csv_file.replace("retail_", "").replace(".csv", ""), "%d_%m_%Y")
-print("Transformation completed!")
+def transform(df: pd.DataFrame, csv_file: str) -> pd.DataFrame:
+    df = df.rename(columns={'description': 'name'})
+    # Stored as 'YYYY-MM-DD', like the historical transactions
+    df["transaction_date"] = file_date(csv_file)
+    return df[COLUMNS]
+
+
+def whole_cents(amount: pd.Series) -> pd.Series:
+    # Rounding to cents when loaded would otherwise change these amounts
+    cents = amount * 100
+    return (cents - cents.round()).abs() < 1e-6
+
+
+# Data quality rules checked during the transform, as column-wide masks of the
+# valid rows. Rejected rows are quarantined with the code of the first failed rule.
+QUALITY_RULES = {
+    'missing_id': lambda df: df['id'].notna() & (df['id'] != ''),
+    'empty_name': lambda df: df['name'].notna() & (df['name'] != ''),
+    'invalid_category': lambda df: df['category'].isin(CATEGORIES),
+    # Comparisons with NaN are false, so missing or non numeric values fail these rules
+    'non_positive_quantity': lambda df: df['quantity'] > 0,
+    'non_positive_amount_excl_tax': lambda df: df['amount_excl_tax'] > 0,
+    'non_positive_amount_inc_tax': lambda df: df['amount_inc_tax'] > 0,
+    # Stored as integers, which would truncate 1.5 or round 1.005 to 1.00
+    'fractional_quantity': lambda df: df['quantity'] % 1 == 0,
+    'sub_cent_amount_excl_tax': lambda df: whole_cents(df['amount_excl_tax']),
+    'sub_cent_amount_inc_tax': lambda df: whole_cents(df['amount_inc_tax']),
+    'tax_mismatch': lambda df: (df['amount_excl_tax'] * (1 + TAX_RATE) - df['amount_inc_tax']).abs() <= TAX_TOLERANCE,
+}
+NUMERIC_COLUMNS = ['quantity', 'amount_excl_tax', 'amount_inc_tax']
+
+
+def validate(df: pd.DataFrame) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Splits transformed rows into valid and rejected ones, the rejected rows
+    getting the code of the first QUALITY_RULES rule they fail as 'reason'.
+    """
+    values = df.assign(**{column: pd.to_numeric(df[column], errors='coerce') for column in NUMERIC_COLUMNS})
+    reason = np.select([~check(values) for check in QUALITY_RULES.values()], list(QUALITY_RULES), default='')
+    valid = reason == ''
+    return df[valid], df[~valid].assign(reason=reason[~valid])
+
 
 # Load
-conn = sqlite3.connect('retail.db')
+SCHEMA_VERSION = 2 # stored in PRAGMA user_version
+# Converts the CSV (or legacy table) columns to the stored ones: dates as a
+# YYYYMMDD integer, amounts as integer cents
+TYPED_COLUMNS = {
+    'id': "CAST(id AS TEXT)",
+    'date_key': "CAST(replace(transaction_date, '-', '') AS INTEGER)",
+    'category': "category",
+    'name': "name",
+    'quantity': "CAST(quantity AS INTEGER)",
+    'amount_excl_tax_cents': "CAST(ROUND(amount_excl_tax * 100) AS INTEGER)",
+    'amount_inc_tax_cents': "CAST(ROUND(amount_inc_tax * 100) AS INTEGER)",
+}
+# Each index covers the columns of a README query, or of legacy queries on the
+# generated transaction_date
+INDEXES = {
+    'transactions_date': "transactions (date_key)",
+    'transactions_transaction_date': "transactions (transaction_date)",
+    'transactions_name': "transactions (name, category, date_key, amount_inc_tax_cents)",
+    'transactions_category': "transactions (category, amount_inc_tax_cents)",
+}
+
+
+def create_transactions(conn: sqlite3.Connection, table: str = 'transactions') -> None:
+    """
+    Creates the typed transactions table. The legacy columns are generated from
+    the stored ones, so queries written against them keep working.
+
+    seq numbers the rows in insertion order. Unlike an implicit rowid, VACUUM
+    and table rebuilds keep it, and AUTOINCREMENT never reuses a value, so
+    summarize() and archive() can rely on it.
+    """
+    conn.execute(f"""
+        CREATE TABLE {table} (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            id TEXT NOT NULL,
+            date_key INTEGER,
+            category TEXT,
+            name TEXT,
+            quantity INTEGER,
+            amount_excl_tax_cents INTEGER,
+            amount_inc_tax_cents INTEGER,
+            transaction_date TEXT AS (printf('%04d-%02d-%02d', date_key / 10000, date_key / 100 % 100, date_key % 100)),
+            amount_excl_tax REAL AS (amount_excl_tax_cents / 100.0),
+            amount_inc_tax REAL AS (amount_inc_tax_cents / 100.0)
+        ) STRICT
+    """)
+
+
+def migrate_transactions(conn: sqlite3.Connection, version: int = 0) -> None:
+    """
+    Copies the transactions table of an older schema version, legacy (TEXT
+    dates, FLOAT amounts) or typed without seq, into the current one. Rows keep
+    their rowid as seq. Duplicated ids loaded before the unique index existed
+    are dropped, keeping the first one. The caller runs it within a transaction.
+    """
+    # Left over by an interrupted migration of an older version of this script
+    conn.execute("DROP TABLE IF EXISTS transactions_typed")
+    create_transactions(conn, 'transactions_typed')
+    columns = TYPED_COLUMNS.values() if version < 1 else TYPED_COLUMNS
+    conn.execute(f"""
+        INSERT INTO transactions_typed (seq, {', '.join(TYPED_COLUMNS)})
+        SELECT rowid, {', '.join(columns)} FROM transactions
+        WHERE id IS NOT NULL AND rowid IN (SELECT MIN(rowid) FROM transactions GROUP BY id)
+        ORDER BY rowid
+    """)
+    conn.execute("DROP TABLE transactions")
+    conn.execute("ALTER TABLE transactions_typed RENAME TO transactions")
+
+
+def ensure_schema(conn: sqlite3.Connection) -> None:
+    """
+    Creates the tables and indexes of the ETL, migrating the database from the
+    schema version found in PRAGMA user_version, within one transaction.
+    """
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    has_transactions = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'transactions'").fetchone()
+    with conn:
+        # sqlite3 opens no transaction before DDL, each statement would commit on its own
+        if not conn.in_transaction:
+            conn.execute("BEGIN")
+        if not has_transactions:
+            create_transactions(conn)
+        elif version < 2:
+            migrate_transactions(conn, version)
+        # The unique index on id is what deduplication relies on
+        conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS transactions_id ON transactions (id)")
+        for name, columns in INDEXES.items():
+            conn.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {columns}")
+
+        # Counts and sums per day, product and category, kept up to date by load()
+        if version < 1:
+            conn.execute("DROP TABLE IF EXISTS daily_summary")
+        has_summary = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'daily_summary'").fetchone()
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS daily_summary (
+                date_key INTEGER NOT NULL,
+                name TEXT NOT NULL,
+                category TEXT NOT NULL,
+                transactions INTEGER NOT NULL,
+                quantity INTEGER NOT NULL,
+                amount_excl_tax_cents INTEGER NOT NULL,
+                amount_inc_tax_cents INTEGER NOT NULL,
+                transaction_date TEXT AS (printf('%04d-%02d-%02d', date_key / 10000, date_key / 100 % 100, date_key % 100)),
+                PRIMARY KEY (date_key, name, category)
+            ) STRICT, WITHOUT ROWID
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS daily_summary_name ON daily_summary (name, date_key)")
+        if not has_summary:
+            summarize(conn)
+
+        # Rows rejected by QUALITY_RULES, kept as read. Columns have no type so that
+        # invalid values are stored unchanged.
+        conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS quarantine (
+                {', '.join(COLUMNS)},
+                reason TEXT NOT NULL,
+                file_name TEXT NOT NULL,
+                quarantined_at TEXT NOT NULL
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS quarantine_file_name ON quarantine (file_name)")
+        # One row per ingested CSV file
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS etl_manifest (
+                file_name TEXT PRIMARY KEY,
+                file_size INTEGER NOT NULL,
+                sha256 TEXT NOT NULL,
+                transaction_date TEXT NOT NULL,
+                rows_read INTEGER NOT NULL,
+                rows_inserted INTEGER NOT NULL,
+                rows_rejected INTEGER NOT NULL DEFAULT 0,
+                loaded_at TEXT NOT NULL
+            )
+        """)
+        # Manifests created before validation existed
+        if 'rows_rejected' not in [column[1] for column in conn.execute("PRAGMA table_info(etl_manifest)")]:
+            conn.execute("ALTER TABLE etl_manifest ADD COLUMN rows_rejected INTEGER NOT NULL DEFAULT 0")
+        conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+
+def summarize(conn: sqlite3.Connection, after_seq: int = 0) -> None:
+    """
+    Adds the transactions stored after after_seq to daily_summary, all of them
+    by default. Rows without date, name or category (which validate() rejects)
+    are left out. The caller commits.
+    """
+    # The WHERE clause lets SQLite parse the upsert clause after a SELECT
+    conn.execute("""
+        INSERT INTO daily_summary (date_key, name, category, transactions, quantity, amount_excl_tax_cents, amount_inc_tax_cents)
+        SELECT date_key, name, category, COUNT(*), TOTAL(quantity), TOTAL(amount_excl_tax_cents), TOTAL(amount_inc_tax_cents)
+        FROM transactions
+        WHERE seq > ? AND date_key IS NOT NULL AND name IS NOT NULL AND category IS NOT NULL
+        GROUP BY date_key, name, category
+        ON CONFLICT (date_key, name, category) DO UPDATE SET
+            transactions = transactions + excluded.transactions,
+            quantity = quantity + excluded.quantity,
+            amount_excl_tax_cents = amount_excl_tax_cents + excluded.amount_excl_tax_cents,
+            amount_inc_tax_cents = amount_inc_tax_cents + excluded.amount_inc_tax_cents
+    """, (after_seq,))
+
+
+def load(df: pd.DataFrame, conn: sqlite3.Connection) -> int:
+    """
+    Inserts the transactions whose id is not in the database yet, adds them to
+    daily_summary, and returns their number.
+
+    Rows go through a temporary staging table, deduplication happens in SQLite
+    against the unique index on id, so the cost only depends on the batch size.
+    The caller commits.
+    """
+    conn.execute(f"CREATE TEMP TABLE IF NOT EXISTS transactions_staging ({', '.join(COLUMNS)})")
+    conn.execute("DELETE FROM transactions_staging")
+    conn.executemany(
+        f"INSERT INTO transactions_staging ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})",
+        df[COLUMNS].itertuples(index=False, name=None),
+    )
+    # New rows get seqs above the current maximum: they are the ones to summarize
+    last_seq = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM transactions").fetchone()[0]
+    # "WHERE true" lets SQLite parse the upsert clause after a SELECT
+    inserted = conn.execute(f"""
+        INSERT INTO transactions ({', '.join(TYPED_COLUMNS)})
+        SELECT {', '.join(TYPED_COLUMNS.values())} FROM transactions_staging WHERE true
+        ON CONFLICT (id) DO NOTHING
+    """).rowcount
+    if inserted:
+        summarize(conn, last_seq)
+    conn.execute("DELETE FROM transactions_staging")
+    return inserted
+
+
+def quarantine(rejected: pd.DataFrame, conn: sqlite3.Connection, file_name: str) -> None:
+    """Stores the rows rejected by validate() with their reason. The caller commits."""
+    quarantined_at = datetime.now(timezone.utc).isoformat(timespec="seconds")
+    # NaN is stored as NULL
+    rows = rejected[COLUMNS + ['reason']]
+    rows = rows.astype(object).where(rows.notna(), None)
+    conn.executemany(
+        f"INSERT INTO quarantine ({', '.join(COLUMNS)}, reason, file_name, quarantined_at) VALUES ({', '.join('?' * (len(COLUMNS) + 3))})",
+        (row + (file_name, quarantined_at) for row in rows.itertuples(index=False, name=None)),
+    )
+
+
+def clear_quarantine(conn: sqlite3.Connection, file_name: str) -> None:
+    """Removes the quarantined rows of a file, before it is ingested again. The caller commits."""
+    conn.execute("DELETE FROM quarantine WHERE file_name = ?", (file_name,))
+
+
+def record(conn: sqlite3.Connection, entry: dict) -> None:
+    """Writes the manifest entry of a loaded file. The caller commits."""
+    entry["loaded_at"] = datetime.now(timezone.utc).isoformat(timespec="seconds")
+    conn.execute(
+        f"INSERT OR REPLACE INTO etl_manifest ({', '.join(entry)}) VALUES ({', '.join('?' * len(entry))})",
+        tuple(entry.values()),
+    )
+
+
+def ingested_size(conn: sqlite3.Connection, file_name: str) -> int | None:
+    """Returns the size of a file when it was ingested, None if it wasn't."""
+    ingested = conn.execute("SELECT file_size FROM etl_manifest WHERE file_name = ?", (file_name,)).fetchone()
+    return ingested and ingested[0]
+
+
+# Backends
+class Backend(ABC):
+    """
+    Database the ETL loads into. A backend opens connections, keeps up to
+    pool_size of them idle for reuse, and implements the load step in its
+    SQL dialect. Every method taking a connection leaves the commit to
+    transaction().
+    """
+
+    def __init__(self, pool_size: int = POOL_SIZE):
+        self.pool = queue.LifoQueue(pool_size)
+
+    @abstractmethod
+    def connect(self):
+        """Opens a new connection to the database."""
+
+    @contextmanager
+    def connection(self):
+        """Lends a pooled connection, opening one when none is idle."""
+        try:
+            conn = self.pool.get_nowait()
+        except queue.Empty:
+            conn = self.connect()
+        try:
+            yield conn
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            try:
+                self.pool.put_nowait(conn)
+            except queue.Full:
+                conn.close()
+
+    def close(self) -> None:
+        """Closes the idle connections."""
+        while True:
+            try:
+                self.pool.get_nowait().close()
+            except queue.Empty:
+                return
+
+    @abstractmethod
+    def transaction(self, conn):
+        """Returns a context manager committing on success, rolling back on error."""
+
+    @abstractmethod
+    def ensure_schema(self, conn) -> None:
+        """Same as the ensure_schema() function of this module."""
+
+    @abstractmethod
+    def load(self, df: pd.DataFrame, conn) -> int:
+        """Same as the load() function of this module."""
+
+    @abstractmethod
+    def quarantine(self, rejected: pd.DataFrame, conn, file_name: str) -> None:
+        """Same as the quarantine() function of this module."""
+
+    @abstractmethod
+    def clear_quarantine(self, conn, file_name: str) -> None:
+        """Same as the clear_quarantine() function of this module."""
+
+    @abstractmethod
+    def record(self, conn, entry: dict) -> None:
+        """Same as the record() function of this module."""
+
+    @abstractmethod
+    def ingested_size(self, conn, file_name: str) -> int | None:
+        """Same as the ingested_size() function of this module."""
+
+    def committed(self, conn) -> None:
+        """Called after each transaction of the pipeline is committed."""
+
+
+class SQLiteBackend(Backend):
+    """
+    Database file opened by connect(), with the functions of this module.
+    Committed transactions are also appended to the Parquet archive of
+    archive_directory, when given.
+    """
+
+    def __init__(self, database: str = DATABASE, synchronous: str = SYNCHRONOUS, cache_size_kib: int = CACHE_SIZE_KIB, pool_size: int = POOL_SIZE,
+                 archive_directory: str | None = None):
+        super().__init__(pool_size)
+        self.database = database
+        self.synchronous = synchronous
+        self.cache_size_kib = cache_size_kib
+        self.archive_directory = archive_directory
+
+    def connect(self) -> sqlite3.Connection:
+        return connect(self.database, self.synchronous, self.cache_size_kib)
+
+    def transaction(self, conn: sqlite3.Connection):
+        # The connection itself commits or rolls back when used as a context manager
+        return conn
+
+    def ensure_schema(self, conn: sqlite3.Connection) -> None:
+        ensure_schema(conn)
+
+    def load(self, df: pd.DataFrame, conn: sqlite3.Connection) -> int:
+        return load(df, conn)
+
+    def quarantine(self, rejected: pd.DataFrame, conn: sqlite3.Connection, file_name: str) -> None:
+        quarantine(rejected, conn, file_name)
+
+    def clear_quarantine(self, conn: sqlite3.Connection, file_name: str) -> None:
+        clear_quarantine(conn, file_name)
+
+    def record(self, conn: sqlite3.Connection, entry: dict) -> None:
+        record(conn, entry)
+
+    def ingested_size(self, conn: sqlite3.Connection, file_name: str) -> int | None:
+        return ingested_size(conn, file_name)
+
+    def committed(self, conn: sqlite3.Connection) -> None:
+        if self.archive_directory:
+            archive(conn, self.archive_directory)
+
+
+class PostgresBackend(Backend):
+    """
+    PostgreSQL database (or any server speaking its protocol), through psycopg.
+
+    Batches are streamed to a temporary staging table with COPY, then inserted
+    with the same deduplication and daily_summary update as SQLite, in a
+    single statement.
+    """
+
+    # Staged values are text, converted like TYPED_COLUMNS. The quality rules
+    # only let through whole quantities and cents, which both convert exactly
+    TYPED_COLUMNS = {
+        'id': "id",
+        'date_key': "replace(transaction_date, '-', '')::integer",
+        'category': "category",
+        'name': "name",
+        'quantity': "trunc(quantity::numeric)::bigint",
+        'amount_excl_tax_cents': "round(amount_excl_tax::numeric * 100)::bigint",
+        'amount_inc_tax_cents': "round(amount_inc_tax::numeric * 100)::bigint",
+    }
+    DATE = "(date_key / 10000)::text || '-' || lpad((date_key / 100 % 100)::text, 2, '0') || '-' || lpad((date_key % 100)::text, 2, '0')"
+
+    def __init__(self, url: str, pool_size: int = POOL_SIZE):
+        super().__init__(pool_size)
+        self.url = url
+
+    def connect(self):
+        if psycopg is None:
+            raise ImportError("PostgresBackend requires psycopg: pip install 'psycopg[binary]'")
+        # Transactions are only opened by transaction()
+        return psycopg.connect(self.url, autocommit=True)
+
+    def transaction(self, conn):
+        return conn.transaction()
+
+    def ensure_schema(self, conn) -> None:
+        with conn.transaction():
+            conn.execute(f"""
+                CREATE TABLE IF NOT EXISTS transactions (
+                    seq BIGINT GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+                    id TEXT NOT NULL,
+                    date_key INTEGER,
+                    category TEXT,
+                    name TEXT,
+                    quantity BIGINT,
+                    amount_excl_tax_cents BIGINT,
+                    amount_inc_tax_cents BIGINT,
+                    transaction_date TEXT GENERATED ALWAYS AS ({self.DATE}) STORED,
+                    amount_excl_tax NUMERIC GENERATED ALWAYS AS (amount_excl_tax_cents / 100.0) STORED,
+                    amount_inc_tax NUMERIC GENERATED ALWAYS AS (amount_inc_tax_cents / 100.0) STORED
+                )
+            """)
+            # Tables created before seq existed, their rows are numbered in no particular order
+            conn.execute("ALTER TABLE transactions ADD COLUMN IF NOT EXISTS seq BIGINT GENERATED ALWAYS AS IDENTITY PRIMARY KEY")
+            conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS transactions_id ON transactions (id)")
+            for name, columns in INDEXES.items():
+                conn.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {columns}")
+            conn.execute(f"""
+                CREATE TABLE IF NOT EXISTS daily_summary (
+                    date_key INTEGER NOT NULL,
+                    name TEXT NOT NULL,
+                    category TEXT NOT NULL,
+                    transactions BIGINT NOT NULL,
+                    quantity BIGINT NOT NULL,
+                    amount_excl_tax_cents BIGINT NOT NULL,
+                    amount_inc_tax_cents BIGINT NOT NULL,
+                    transaction_date TEXT GENERATED ALWAYS AS ({self.DATE}) STORED,
+                    PRIMARY KEY (date_key, name, category)
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS daily_summary_name ON daily_summary (name, date_key)")
+            conn.execute(f"""
+                CREATE TABLE IF NOT EXISTS quarantine (
+                    {', '.join(f'{column} TEXT' for column in COLUMNS)},
+                    reason TEXT NOT NULL,
+                    file_name TEXT NOT NULL,
+                    quarantined_at TEXT NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS quarantine_file_name ON quarantine (file_name)")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS etl_manifest (
+                    file_name TEXT PRIMARY KEY,
+                    file_size BIGINT NOT NULL,
+                    sha256 TEXT NOT NULL,
+                    transaction_date TEXT NOT NULL,
+                    rows_read BIGINT NOT NULL,
+                    rows_inserted BIGINT NOT NULL,
+                    rows_rejected BIGINT NOT NULL DEFAULT 0,
+                    loaded_at TEXT NOT NULL
+                )
+            """)
+
+    def copy(self, conn, table: str, columns: list, rows) -> None:
+        with conn.cursor().copy(f"COPY {table} ({', '.join(columns)}) FROM STDIN") as copy:
+            for row in rows:
+                copy.write_row(row)
+
+    def load(self, df: pd.DataFrame, conn) -> int:
+        conn.execute(f"CREATE TEMP TABLE IF NOT EXISTS transactions_staging ({', '.join(f'{column} TEXT' for column in COLUMNS)})")
+        conn.execute("TRUNCATE transactions_staging")
+        self.copy(conn, "transactions_staging", COLUMNS, df[COLUMNS].itertuples(index=False, name=None))
+        # The inserted rows are summarized by the same statement
+        inserted = conn.execute(f"""
+            WITH inserted AS (
+                INSERT INTO transactions ({', '.join(self.TYPED_COLUMNS)})
+                SELECT {', '.join(self.TYPED_COLUMNS.values())} FROM transactions_staging
+                ON CONFLICT (id) DO NOTHING
+                RETURNING date_key, name, category, quantity, amount_excl_tax_cents, amount_inc_tax_cents
+            ), summary AS (
+                INSERT INTO daily_summary (date_key, name, category, transactions, quantity, amount_excl_tax_cents, amount_inc_tax_cents)
+                SELECT date_key, name, category, COUNT(*), COALESCE(SUM(quantity), 0), COALESCE(SUM(amount_excl_tax_cents), 0), COALESCE(SUM(amount_inc_tax_cents), 0)
+                FROM inserted
+                WHERE date_key IS NOT NULL AND name IS NOT NULL AND category IS NOT NULL
+                GROUP BY date_key, name, category
+                ON CONFLICT (date_key, name, category) DO UPDATE SET
+                    transactions = daily_summary.transactions + excluded.transactions,
+                    quantity = daily_summary.quantity + excluded.quantity,
+                    amount_excl_tax_cents = daily_summary.amount_excl_tax_cents + excluded.amount_excl_tax_cents,
+                    amount_inc_tax_cents = daily_summary.amount_inc_tax_cents + excluded.amount_inc_tax_cents
+            )
+            SELECT COUNT(*) FROM inserted
+        """).fetchone()[0]
+        conn.execute("TRUNCATE transactions_staging")
+        return inserted
+
+    def quarantine(self, rejected: pd.DataFrame, conn, file_name: str) -> None:
+        quarantined_at = datetime.now(timezone.utc).isoformat(timespec="seconds")
+        rows = rejected[COLUMNS + ['reason']]
+        rows = rows.astype(object).where(rows.notna(), None)
+        self.copy(
+            conn, "quarantine", COLUMNS + ['reason', 'file_name', 'quarantined_at'],
+            (tuple(None if value is None else str(value) for value in row) + (file_name, quarantined_at) for row in rows.itertuples(index=False, name=None)),
+        )
+
+    def clear_quarantine(self, conn, file_name: str) -> None:
+        conn.execute("DELETE FROM quarantine WHERE file_name = %s", (file_name,))
+
+    def record(self, conn, entry: dict) -> None:
+        entry["loaded_at"] = datetime.now(timezone.utc).isoformat(timespec="seconds")
+        conn.execute(
+            f"""
+            INSERT INTO etl_manifest ({', '.join(entry)}) VALUES ({', '.join(['%s'] * len(entry))})
+            ON CONFLICT (file_name) DO UPDATE SET {', '.join(f'{column} = excluded.{column}' for column in entry if column != 'file_name')}
+            """,
+            tuple(entry.values()),
+        )
+
+    def ingested_size(self, conn, file_name: str) -> int | None:
+        ingested = conn.execute("SELECT file_size FROM etl_manifest WHERE file_name = %s", (file_name,)).fetchone()
+        return ingested and ingested[0]
+
+
+DEFAULT_BACKEND = SQLiteBackend()
+
+
+def open_backend(url: str, **options) -> Backend:
+    """
+    Returns the backend of a database URL: postgresql://... (or postgres://...),
+    sqlite:///path, or a plain SQLite file path. options go to the SQLite backend.
+    """
+    if url.startswith(("postgresql://", "postgres://")):
+        if options.get("archive_directory"):
+            raise ValueError("The Parquet archive is only available with SQLite")
+        return PostgresBackend(url)
+    if url.startswith("sqlite:///"):
+        return SQLiteBackend(url.removeprefix("sqlite:///"), **options)
+    if "://" in url:
+        raise ValueError(f"Unsupported database URL: {url}")
+    return SQLiteBackend(url, **options)
+
+
+def skip_file(csv_file: str, error: Exception) -> None:
+    print(f"Skipping {csv_file}: {error}")
+
+
+def pending_files(conn, drop_directory: str, backend: Backend = DEFAULT_BACKEND, on_error=skip_file) -> list:
+    """
+    Lists the retail_DD_MM_YYYY.csv files of the drop directory that are not in
+    the manifest yet (or whose size changed since), oldest transaction date first.
+
+    Ingested files are recognised from their name and size only, so they are
+    skipped without being read. Files named after an invalid date, or gone
+    before their size is read, are passed to on_error(csv_file, error) and left out.
+    """
+    pending = []
+    for csv_file in glob.glob(os.path.join(drop_directory, "retail_*.csv")):
+        if not FILE_PATTERN.fullmatch(os.path.basename(csv_file)):
+            continue
+        try:
+            transaction_date = file_date(csv_file)
+            if backend.ingested_size(conn, os.path.basename(csv_file)) != os.path.getsize(csv_file):
+                pending.append((transaction_date, csv_file))
+        except (ValueError, OSError) as error:
+            on_error(csv_file, error)
+    return [csv_file for transaction_date, csv_file in sorted(pending)]
+
+
+def file_entry(csv_file: str) -> dict:
+    """Returns the manifest entry of a CSV file, before any row is read."""
+    return {
+        "file_name": os.path.basename(csv_file),
+        "file_size": os.path.getsize(csv_file),
+        "sha256": file_sha256(csv_file),
+        "transaction_date": file_date(csv_file),
+        "rows_read": 0,
+        "rows_inserted": 0,
+        "rows_rejected": 0,
+    }
+
+
+def report(entry: dict) -> None:
+    if entry["rows_rejected"]:
+        print(f"Quarantined {entry['rows_rejected']} invalid records.")
+    if entry["rows_inserted"]:
+        print(f"Inserted {entry['rows_inserted']} new records.")
+    else:
+        print("No new records to insert.")
+
+
+def process_file(conn, csv_file: str, chunk_rows: int = CHUNK_ROWS, backend: Backend = DEFAULT_BACKEND) -> dict:
+    """
+    Runs the ETL for one CSV file, streaming it chunk_rows rows at a time so
+    memory doesn't depend on its size. The whole file is loaded and recorded
+    in the manifest within a single transaction.
+    """
+    entry = file_entry(csv_file)
+    with backend.transaction(conn):
+        # A file ingested again replaces its quarantined rows
+        backend.clear_quarantine(conn, entry["file_name"])
+        # Extract
+        for df in extract_chunks(csv_file, chunk_rows):
+            # Transform
+            df, rejected = validate(transform(df, csv_file))
+
+            # Load
+            entry["rows_read"] += len(df) + len(rejected)
+            entry["rows_rejected"] += len(rejected)
+            entry["rows_inserted"] += backend.load(df, conn)
+            backend.quarantine(rejected, conn, entry["file_name"])
+        backend.record(conn, entry)
+    backend.committed(conn)
+    return entry
+
+
+def run(conn, drop_directory: str = DROP_DIRECTORY, chunk_rows: int = CHUNK_ROWS, backend: Backend = DEFAULT_BACKEND) -> list:
+    """Ingests every pending file of the drop directory, and returns their manifest entries."""
+    entries = []
+    for csv_file in pending_files(conn, drop_directory, backend):
+        print(f"Processing {csv_file}")
+        entry = process_file(conn, csv_file, chunk_rows, backend)
+        report(entry)
+        entries.append(entry)
+    return entries
+
+
+def prepare_file(csv_file: str) -> tuple[dict, pd.DataFrame, pd.DataFrame]:
+    """
+    Extracts, transforms and validates a whole CSV file in a worker process,
+    and returns its manifest entry with the valid and rejected rows.
+    """
+    entry = file_entry(csv_file)
+    df, rejected = validate(transform(pd.read_csv(csv_file), csv_file))
+    entry["rows_read"] = len(df) + len(rejected)
+    entry["rows_rejected"] = len(rejected)
+    return entry, df, rejected
+
+
+def write_batch(conn, batch: list, backend: Backend = DEFAULT_BACKEND) -> None:
+    """Loads and quarantines the prepared files of a batch, and records them in the manifest, within one transaction."""
+    with backend.transaction(conn):
+        for entry, df, rejected in batch:
+            backend.clear_quarantine(conn, entry["file_name"])
+            entry["rows_inserted"] = backend.load(df, conn)
+            backend.quarantine(rejected, conn, entry["file_name"])
+            backend.record(conn, entry)
+    backend.committed(conn)
+    for entry, df, rejected in batch:
+        report(entry)
+
+
+def run_parallel(conn, drop_directory: str = DROP_DIRECTORY, workers: int = WORKERS, batch_rows: int = BATCH_ROWS, backend: Backend = DEFAULT_BACKEND) -> list:
+    """
+    Ingests every pending file of the drop directory like run(), with the files
+    parsed, transformed and validated by a pool of worker processes.
+
+    The calling process is the only writer: it loads the prepared files in date
+    order and commits once batch_rows rows are pending, so the database never
+    sees concurrent writers. At most two files per worker are in flight, which
+    bounds memory when the writer falls behind.
+
+    Unlike run(), each file is held in memory as a whole, and most of the load
+    time is spent in the single writer anyway: main() only uses this path when
+    --workers is given above 1.
+    """
+    pending = iter(pending_files(conn, drop_directory, backend))
+    entries, batch, pending_rows = [], [], 0
+    with ProcessPoolExecutor(workers) as executor:
+        in_flight = deque(executor.submit(prepare_file, csv_file) for csv_file in itertools.islice(pending, 2 * workers))
+        while in_flight:
+            entry, df, rejected = in_flight.popleft().result()
+            if (csv_file := next(pending, None)) is not None:
+                in_flight.append(executor.submit(prepare_file, csv_file))
+            print(f"Processing {os.path.join(drop_directory, entry['file_name'])}")
+            batch.append((entry, df, rejected))
+            entries.append(entry)
+            pending_rows += len(df)
+            if pending_rows >= batch_rows:
+                write_batch(conn, batch, backend)
+                batch, pending_rows = [], 0
+    if batch:
+        write_batch(conn, batch, backend)
+    return entries
+
+
+def latency_summary(latencies: list) -> dict:
+    """Returns the count, median, 95th percentile and maximum of latencies, in seconds."""
+    if not latencies:
+        return {"files": 0}
+    latencies = sorted(latencies)
+    return {
+        "files": len(latencies),
+        "p50_seconds": latencies[(len(latencies) - 1) // 2],
+        "p95_seconds": latencies[int(0.95 * (len(latencies) - 1))],
+        "max_seconds": latencies[-1],
+    }
+
+
+def watch(conn, drop_directory: str = DROP_DIRECTORY, backend: Backend = DEFAULT_BACKEND, poll_interval: float = POLL_INTERVAL,
+          batch_window: float = BATCH_WINDOW, max_batches: int | None = None, metrics=sys.stderr) -> list:
+    """
+    Ingests the files of the drop directory as they arrive, through the same
+    connection, until interrupted (or after max_batches micro-batches).
+
+    The directory is polled every poll_interval seconds. A file is ready once
+    its size and modification time didn't change between two scans, so files
+    still being written are left alone. Files ready within batch_window seconds
+    of the first one are loaded as one micro-batch, in one transaction.
+
+    Each batch is reported to metrics as a JSON line, with the latency of every
+    file from its arrival (first scan that saw it) to the commit. A file that
+    fails is reported and skipped until it changes. Returns the manifest entries
+    of the loaded files, with their 'latency_seconds'. Files that can't even be
+    scanned (invalid date, removed meanwhile) are reported the same way.
+    """
+    def emit(event: dict) -> None:
+        print(json.dumps(event), file=metrics, flush=True)
+
+    def scan_error(csv_file: str, error: Exception) -> None:
+        # Reported once per version of the file, or once it is gone
+        try:
+            stat = os.stat(csv_file)
+            signature = (stat.st_size, stat.st_mtime_ns)
+        except OSError:
+            signature = None
+        seen.pop(csv_file, None)
+        if csv_file not in failed or failed[csv_file] != signature:
+            failed[csv_file] = signature
+            emit({"event": "error", "file": os.path.basename(csv_file), "error": repr(error)})
+
+    seen = {} # path -> (size, mtime_ns, arrival)
+    failed = {} # path -> (size, mtime_ns) of the version that failed, None if it was gone
+    entries, batches, ready_since = [], 0, None
+    try:
+        while max_batches is None or batches < max_batches:
+            now = time.monotonic()
+            ready = []
+            for csv_file in pending_files(conn, drop_directory, backend, on_error=scan_error):
+                try:
+                    stat = os.stat(csv_file)
+                except OSError as error:
+                    scan_error(csv_file, error)
+                    continue
+                signature = (stat.st_size, stat.st_mtime_ns)
+                previous = seen.get(csv_file)
+                if previous is None or previous[:2] != signature:
+                    seen[csv_file] = (*signature, previous[2] if previous else now)
+                elif failed.get(csv_file) != signature:
+                    ready.append(csv_file)
+            if not ready:
+                ready_since = None
+            elif ready_since is None:
+                ready_since = now
+
+            if ready and now - ready_since >= batch_window:
+                batch = []
+                for csv_file in ready:
+                    try:
+                        batch.append(prepare_file(csv_file))
+                    except Exception as error:
+                        failed[csv_file] = seen[csv_file][:2]
+                        emit({"event": "error", "file": os.path.basename(csv_file), "error": repr(error)})
+                if batch:
+                    write_batch(conn, batch, backend)
+                    committed = time.monotonic()
+                    for entry, df, rejected in batch:
+                        entry["latency_seconds"] = committed - seen.pop(os.path.join(drop_directory, entry["file_name"]))[2]
+                        entries.append(entry)
+                    batches += 1
+                    emit({
+                        "event": "batch",
+                        "files": [entry["file_name"] for entry, df, rejected in batch],
+                        "rows_inserted": sum(entry["rows_inserted"] for entry, df, rejected in batch),
+                        "rows_rejected": sum(entry["rows_rejected"] for entry, df, rejected in batch),
+                        "latency_seconds": [entry["latency_seconds"] for entry, df, rejected in batch],
+                    })
+                ready_since = None
+                continue
+            time.sleep(poll_interval)
+    except KeyboardInterrupt:
+        pass
+    emit({"event": "summary", "batches": batches, **latency_summary([entry["latency_seconds"] for entry in entries])})
+    return entries
+
+
+# Archive
+ARCHIVE_WATERMARK = '_archived_seq' # pyarrow datasets skip files starting with '_'
+# Written before seq existed, its rowids became the seqs of the migrated rows
+LEGACY_ARCHIVE_WATERMARK = '_archived_rowid'
+if pa is not None:
+    ARCHIVE_SCHEMA = pa.schema([
+        ('id', pa.string()),
+        ('date_key', pa.int32()),
+        ('category', pa.string()),
+        ('name', pa.string()),
+        ('quantity', pa.int64()),
+        ('amount_excl_tax_cents', pa.int64()),
+        ('amount_inc_tax_cents', pa.int64()),
+        ('transaction_date', pa.string()),
+    ])
+    ARCHIVE_PARTITIONING = ds.partitioning(pa.schema([('transaction_date', pa.string())]), flavor='hive')
+
+
+def archive(conn: sqlite3.Connection, archive_directory: str, chunk_rows: int = BATCH_ROWS) -> int:
+    """
+    Appends the transactions stored since the previous call to a Parquet
+    dataset partitioned by date (transaction_date=YYYY-MM-DD/ directories),
+    and returns their number. The first call exports the whole table.
+
+    Archived files are never rewritten, so the archive can be read while it
+    grows. The seq of the last archived transaction is kept in the archive,
+    and written after the data it covers.
+    """
+    if ds is None:
+        raise ImportError("The archive requires pyarrow: pip install pyarrow")
+    watermark = os.path.join(archive_directory, ARCHIVE_WATERMARK)
+    archived_seq = 0
+    for watermark_file in (watermark, os.path.join(archive_directory, LEGACY_ARCHIVE_WATERMARK)):
+        if os.path.exists(watermark_file):
+            with open(watermark_file) as f:
+                archived_seq = int(f.read())
+            break
+    cursor = conn.execute(f"SELECT seq, {', '.join(ARCHIVE_SCHEMA.names)} FROM transactions WHERE seq > ? ORDER BY seq", (archived_seq,))
+    archived = 0
+    while rows := cursor.fetchmany(chunk_rows):
+        seqs, *columns = zip(*rows)
+        table = pa.Table.from_arrays([pa.array(column, type=field.type) for column, field in zip(columns, ARCHIVE_SCHEMA)], schema=ARCHIVE_SCHEMA)
+        # Files are named after the first seq of their chunk: the files of a
+        # chunk written before a crash, and not covered by the watermark, are
+        # replaced by the retry instead of being counted twice
+        for stale_file in glob.glob(os.path.join(archive_directory, '*', f"{seqs[0]}-*.parquet")):
+            os.remove(stale_file)
+        ds.write_dataset(
+            table, archive_directory, format='parquet', partitioning=ARCHIVE_PARTITIONING,
+            basename_template=f"{seqs[0]}-{{i}}.parquet", existing_data_behavior='overwrite_or_ignore',
+        )
+        archived += len(rows)
+        with open(f"{watermark}.tmp", 'w') as f:
+            f.write(str(seqs[-1]))
+        os.replace(f"{watermark}.tmp", watermark)
+    return archived
+
+
+def archive_dataset(archive_directory: str):
+    """Opens the archive as a pyarrow dataset, its files being memory-mapped."""
+    return ds.dataset(os.path.abspath(archive_directory), format='parquet', partitioning=ARCHIVE_PARTITIONING, filesystem=pyarrow.fs.LocalFileSystem(use_mmap=True))
+
+
+def archive_category_total(archive_directory: str, category: str = 'SELL') -> float:
+    """Like category_total(), from the archive."""
+    table = archive_dataset(archive_directory).to_table(columns=['amount_inc_tax_cents'], filter=ds.field('category') == category)
+    return (pc.sum(table['amount_inc_tax_cents']).as_py() or 0) / 100
+
+
+def archive_balance(archive_directory: str, name: str) -> list:
+    """Like balance(), from the archive: only the date, category and amount columns of the product's rows are read."""
+    table = archive_dataset(archive_directory).to_table(
+        columns=['transaction_date', 'category', 'amount_inc_tax_cents'],
+        filter=(ds.field('name') == name) & ds.field('category').isin(CATEGORIES),
+    )
+    signed = pc.if_else(pc.equal(table['category'], 'SELL'), table['amount_inc_tax_cents'], pc.negate(table['amount_inc_tax_cents']))
+    balances = pa.table({'transaction_date': table['transaction_date'], 'balance': signed}).group_by('transaction_date').aggregate([('balance', 'sum')])
+    balances = balances.sort_by('transaction_date')
+    return [(date, cents / 100) for date, cents in zip(balances['transaction_date'].to_pylist(), balances['balance_sum'].to_pylist())]
+
+
+def archive_cumulative_balance(archive_directory: str, name: str) -> list:
+    """Like cumulative_balance(), from the archive."""
+    balances = archive_balance(archive_directory, name)
+    cumulated = itertools.accumulate(round(balance * 100) for date, balance in balances)
+    return [(date, cents / 100) for (date, balance), cents in zip(balances, cumulated)]
+
+
+# Reports
+def transaction_counts(conn: sqlite3.Connection) -> dict:
+    """Returns the number of transactions by date."""
+    return dict(conn.execute("SELECT transaction_date, SUM(transactions) FROM daily_summary GROUP BY date_key ORDER BY date_key"))
+
+
+def category_total(conn: sqlite3.Connection, category: str = 'SELL') -> float:
+    """Returns the total amount, including tax, of the transactions of a category."""
+    return conn.execute("SELECT TOTAL(amount_inc_tax_cents) / 100 FROM daily_summary WHERE category = ?", (category,)).fetchone()[0]
+
+
+def balance(conn: sqlite3.Connection, name: str) -> list:
+    """Returns the (date, SELL - BUY amount including tax) of a product, by date."""
+    return conn.execute("""
+        SELECT transaction_date, TOTAL(CASE category WHEN 'SELL' THEN amount_inc_tax_cents WHEN 'BUY' THEN -amount_inc_tax_cents END) / 100
+        FROM daily_summary WHERE name = ?
+        GROUP BY date_key ORDER BY date_key
+    """, (name,)).fetchall()
+
+
+def cumulative_balance(conn: sqlite3.Connection, name: str) -> list:
+    """Returns the (date, SELL - BUY amount including tax up to that date) of a product, by date."""
+    return conn.execute("""
+        SELECT transaction_date, SUM(TOTAL(CASE category WHEN 'SELL' THEN amount_inc_tax_cents WHEN 'BUY' THEN -amount_inc_tax_cents END)) OVER (ORDER BY date_key) / 100
+        FROM daily_summary WHERE name = ?
+        GROUP BY date_key ORDER BY date_key
+    """, (name,)).fetchall()
+
+
+def main(argv: list | None = None) -> None:
+    parser = argparse.ArgumentParser(description="Loads the retail_DD_MM_YYYY.csv files of a drop directory into the database.")
+    parser.add_argument("--drop-dir", default=DROP_DIRECTORY, help="directory receiving the CSV files")
+    parser.add_argument("--db", default=os.environ.get(DATABASE_URL_VARIABLE, DATABASE), help=f"SQLite database file or database URL, ${DATABASE_URL_VARIABLE} by default")
+    parser.add_argument("--chunk-rows", type=int, default=CHUNK_ROWS, help="CSV rows read and inserted at once")
+    parser.add_argument("--synchronous", default=SYNCHRONOUS, choices=SYNCHRONOUS_LEVELS, type=str.upper, help="SQLite synchronous level")
+    parser.add_argument("--cache-size", type=int, default=CACHE_SIZE_KIB, help="SQLite page cache size, in KiB")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="processes transforming whole files in parallel, memory growing with the file sizes (1 streams them chunk by chunk)")
+    parser.add_argument("--batch-rows", type=int, default=BATCH_ROWS, help="rows committed at once when --workers is above 1")
+    parser.add_argument("--archive", help="directory of a Parquet archive of the transactions, partitioned by date, appended after each load (SQLite only)")
+    parser.add_argument("--watch", action="store_true", help="keep running and ingest files as they arrive, with latency metrics as JSON lines on stderr")
+    parser.add_argument("--poll-interval", type=float, default=POLL_INTERVAL, help="seconds between two scans of the drop directory in watch mode")
+    parser.add_argument("--batch-window", type=float, default=BATCH_WINDOW, help="seconds to wait for more files before loading a micro-batch in watch mode")
+    args = parser.parse_args(argv)
+
+    if not args.watch and not glob.glob(os.path.join(args.drop_dir, "*.csv")):
+        raise FileNotFoundError("Aucun fichier CSV trouvé dans le répertoire spécifié.")
+
+    backend = open_backend(args.db, synchronous=args.synchronous, cache_size_kib=args.cache_size, archive_directory=args.archive)
+    with backend.connection() as conn:
+        backend.ensure_schema(conn)
+        if args.archive:
+            # Catches up with the transactions loaded without the archive
+            archive(conn, args.archive)
+
+        if args.watch:
+            # SIGTERM stops the daemon like Ctrl+C: a batch being written is rolled back, and loaded again at the next start
+            signal.signal(signal.SIGTERM, signal.default_int_handler)
+            entries = watch(conn, args.drop_dir, backend, args.poll_interval, args.batch_window)
+        elif args.workers > 1:
+            entries = run_parallel(conn, args.drop_dir, args.workers, args.batch_rows, backend)
+        else:
+            entries = run(conn, args.drop_dir, args.chunk_rows, backend)
+        if not entries and not args.watch:
+            print("Every CSV file was already ingested.")
 
-existing_ids_query = "SELECT id FROM transactions"
-existing_ids = pd.read_sql(existing_ids_query, conn)['id'].tolist()
+    backend.close()
 
-df_new = df[~df['id'].isin(existing_ids)]
-if not df_new.empty:
-    df_new.to_sql('transactions', conn, if_exists='append', index=False)
-    print(f"Inserted {len(df_new)} new records.")
-else:
-    print("No new records to insert.")
+    print("Data loaded successfully!")
 
-conn.commit()
-conn.close()
 
-print("Data loaded successfully!")
\ No newline at end of file
+if __name__ == "__main__":
+    main()
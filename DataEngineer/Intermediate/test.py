@@ -1,5 +1,21 @@
-import unittest
+import io
+import json
+import os
+import shutil
 import sqlite3
+import tempfile
+import unittest
+from unittest import mock
+
+import pandas as pd
+
+import etl
+
+try:
+    import pgserver
+except ImportError:
+    # PostgresBackendTest then needs RETAIL_TEST_DATABASE_URL
+    pgserver = None
 
 
 class TransactionTest(unittest.TestCase):
@@ -74,5 +90,613 @@ class TransactionTest(unittest.TestCase):
         self.conn.close()
 
 
+class LoadTest(unittest.TestCase):
+    def setUp(self):
+        self.conn = sqlite3.connect(':memory:')
+        etl.ensure_schema(self.conn)
+        self.df = etl.transform(pd.read_csv('retail_15_01_2022.csv'), 'retail_15_01_2022.csv')
+
+    def test_load_skips_existing_ids(self):
+        self.assertEqual(etl.load(self.df, self.conn), 54)
+        self.assertEqual(etl.load(self.df, self.conn), 0)
+
+        result = self.conn.execute("SELECT COUNT(*) FROM transactions WHERE transaction_date = '2022-01-15'").fetchone()[0]
+        self.assertEqual(result, 54)
+
+    def test_load_skips_duplicated_ids_in_batch(self):
+        inserted = etl.load(etl.pd.concat([self.df.head(3), self.df.head(3)]), self.conn)
+
+        self.assertEqual(inserted, 3)
+
+    def test_ensure_schema_removes_duplicates_before_indexing(self):
+        conn = sqlite3.connect(':memory:')
+        conn.execute("CREATE TABLE transactions (id TEXT, transaction_date TEXT, category TEXT, name TEXT, quantity BIGINT, amount_excl_tax FLOAT, amount_inc_tax FLOAT)")
+        conn.executemany("INSERT INTO transactions (id) VALUES (?)", [('a',), ('a',), ('b',)])
+
+        etl.ensure_schema(conn)
+
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM transactions").fetchone()[0], 2)
+        plan = conn.execute("EXPLAIN QUERY PLAN SELECT 1 FROM transactions WHERE id = 'a'").fetchall()
+        self.assertIn("transactions_id", plan[0][-1])
+
+    def tearDown(self):
+        self.conn.close()
+
+
+class ManifestTest(unittest.TestCase):
+    def setUp(self):
+        self.conn = sqlite3.connect(':memory:')
+        etl.ensure_schema(self.conn)
+        self.drop_directory = tempfile.mkdtemp()
+        shutil.copy('retail_15_01_2022.csv', self.drop_directory)
+
+    def test_file_date(self):
+        self.assertEqual(etl.file_date('drop/retail_15_01_2022.csv'), '2022-01-15')
+        with self.assertRaises(ValueError):
+            etl.file_date('retail_2022_01_15.csv')
+
+    def test_run_records_and_skips_ingested_files(self):
+        entries = etl.run(self.conn, self.drop_directory)
+
+        self.assertEqual([(entry['file_name'], entry['rows_read'], entry['rows_inserted']) for entry in entries], [('retail_15_01_2022.csv', 54, 54)])
+        manifest = self.conn.execute("SELECT file_name, file_size, transaction_date FROM etl_manifest").fetchall()
+        self.assertEqual(manifest, [('retail_15_01_2022.csv', os.path.getsize('retail_15_01_2022.csv'), '2022-01-15')])
+        self.assertEqual(etl.pending_files(self.conn, self.drop_directory), [])
+        self.assertEqual(etl.run(self.conn, self.drop_directory), [])
+
+    def test_run_skips_invalid_dates(self):
+        shutil.copy('retail_15_01_2022.csv', os.path.join(self.drop_directory, 'retail_31_02_2022.csv'))
+        skipped = []
+
+        pending = etl.pending_files(self.conn, self.drop_directory, on_error=lambda csv_file, error: skipped.append(os.path.basename(csv_file)))
+        self.assertEqual([os.path.basename(csv_file) for csv_file in pending], ['retail_15_01_2022.csv'])
+        self.assertEqual(skipped, ['retail_31_02_2022.csv'])
+        entries = etl.run(self.conn, self.drop_directory)
+        self.assertEqual([entry['file_name'] for entry in entries], ['retail_15_01_2022.csv'])
+
+    def test_run_streams_small_chunks(self):
+        entries = etl.run(self.conn, self.drop_directory, chunk_rows=10)
+
+        self.assertEqual((entries[0]['rows_read'], entries[0]['rows_inserted']), (54, 54))
+        self.assertEqual(self.conn.execute("SELECT COUNT(DISTINCT id) FROM transactions").fetchone()[0], 54)
+
+    def test_connect_pragmas(self):
+        conn = etl.connect(os.path.join(self.drop_directory, 'retail.db'), synchronous='full', cache_size_kib=1024)
+
+        self.assertEqual(conn.execute("PRAGMA journal_mode").fetchone()[0], 'wal')
+        self.assertEqual(conn.execute("PRAGMA synchronous").fetchone()[0], 2)
+        self.assertEqual(conn.execute("PRAGMA cache_size").fetchone()[0], -1024)
+        conn.close()
+        with self.assertRaises(ValueError):
+            etl.connect(':memory:', synchronous='sometimes')
+
+    def test_run_processes_files_by_date(self):
+        with open(os.path.join(self.drop_directory, 'retail_14_01_2022.csv'), 'w') as f:
+            f.write("id,category,description,quantity,amount_excl_tax,amount_inc_tax\n")
+            f.write("new-id,SELL,Amazon Echo Dot,1,24.99,29.99\n")
+        open(os.path.join(self.drop_directory, 'retail_backup.csv'), 'w').close()
+
+        entries = etl.run(self.conn, self.drop_directory)
+
+        self.assertEqual([entry['transaction_date'] for entry in entries], ['2022-01-14', '2022-01-15'])
+        result = self.conn.execute("SELECT transaction_date FROM transactions WHERE id = 'new-id'").fetchone()[0]
+        self.assertEqual(result, '2022-01-14')
+
+    def test_validate_rejects_invalid_rows(self):
+        df = etl.pd.DataFrame({
+            'id': ['ok', 'zero', 'kind', 'tax', 'empty', 'half', 'sub-cent'],
+            'name': ['Amazon Echo Dot'] * 7,
+            'category': ['SELL', 'BUY', 'GIFT', 'SELL', 'BUY', 'SELL', 'SELL'],
+            'quantity': [1, 0, 1, 1, None, 1.5, 1],
+            'amount_excl_tax': [24.99, 24.99, 24.99, 24.99, 24.99, 24.99, 1.005],
+            'amount_inc_tax': [29.99, 29.99, 29.99, 24.99, 29.99, 29.99, 1.21],
+        })
+
+        valid, rejected = etl.validate(df)
+
+        self.assertEqual(list(valid['id']), ['ok'])
+        self.assertEqual(list(zip(rejected['id'], rejected['reason'])), [
+            ('zero', 'non_positive_quantity'), ('kind', 'invalid_category'), ('tax', 'tax_mismatch'), ('empty', 'non_positive_quantity'),
+            ('half', 'fractional_quantity'), ('sub-cent', 'sub_cent_amount_excl_tax'),
+        ])
+
+    def test_run_drops_and_counts_invalid_rows(self):
+        with open(os.path.join(self.drop_directory, 'retail_14_01_2022.csv'), 'w') as f:
+            f.write("id,category,description,quantity,amount_excl_tax,amount_inc_tax\n")
+            f.write("valid-id,SELL,Amazon Echo Dot,1,24.99,29.99\n")
+            f.write("invalid-id,SELL,Amazon Echo Dot,-1,24.99,29.99\n")
+
+        entries = etl.run(self.conn, self.drop_directory)
+
+        self.assertEqual([(entry['rows_read'], entry['rows_rejected'], entry['rows_inserted']) for entry in entries], [(2, 1, 1), (54, 0, 54)])
+        self.assertIsNone(self.conn.execute("SELECT 1 FROM transactions WHERE id = 'invalid-id'").fetchone())
+        quarantined = self.conn.execute("SELECT id, quantity, reason, file_name FROM quarantine").fetchall()
+        self.assertEqual(quarantined, [('invalid-id', -1, 'non_positive_quantity', 'retail_14_01_2022.csv')])
+
+    def test_quarantine_keeps_invalid_values(self):
+        with open(os.path.join(self.drop_directory, 'retail_14_01_2022.csv'), 'w') as f:
+            f.write("id,category,description,quantity,amount_excl_tax,amount_inc_tax\n")
+            f.write("no-name,SELL,,1,24.99,29.99\n")
+            f.write("no-amount,GIFT,Amazon Echo Dot,one,,29.99\n")
+            f.write("bad-tax,BUY,Amazon Echo Dot,1,24.99,24.99\n")
+
+        etl.run_parallel(self.conn, self.drop_directory, workers=1)
+
+        quarantined = self.conn.execute("SELECT id, quantity, amount_excl_tax, reason FROM quarantine ORDER BY id").fetchall()
+        # 'one' turns the whole quantity column into text
+        self.assertEqual(quarantined, [('bad-tax', '1', 24.99, 'tax_mismatch'), ('no-amount', 'one', None, 'invalid_category'), ('no-name', '1', 24.99, 'empty_name')])
+
+    def test_run_parallel_matches_run(self):
+        for day in ('13', '14'):
+            etl.pd.read_csv('retail_15_01_2022.csv').assign(id=lambda df: day + df['id']).to_csv(os.path.join(self.drop_directory, f'retail_{day}_01_2022.csv'), index=False)
+        conn = sqlite3.connect(':memory:')
+        etl.ensure_schema(conn)
+
+        expected = etl.run(conn, self.drop_directory)
+        entries = etl.run_parallel(self.conn, self.drop_directory, workers=2, batch_rows=60)
+
+        def without_time(entries):
+            return [{key: value for key, value in entry.items() if key != 'loaded_at'} for entry in entries]
+        self.assertEqual(without_time(entries), without_time(expected))
+        query = "SELECT transaction_date, COUNT(*) FROM transactions GROUP BY transaction_date"
+        self.assertEqual(self.conn.execute(query).fetchall(), conn.execute(query).fetchall())
+        self.assertEqual(etl.pending_files(self.conn, self.drop_directory), [])
+        conn.close()
+
+    def test_ensure_schema_adds_rows_rejected_to_old_manifests(self):
+        conn = sqlite3.connect(':memory:')
+        conn.execute("CREATE TABLE etl_manifest (file_name TEXT PRIMARY KEY, file_size INTEGER NOT NULL, sha256 TEXT NOT NULL, transaction_date TEXT NOT NULL, rows_read INTEGER NOT NULL, rows_inserted INTEGER NOT NULL, loaded_at TEXT NOT NULL)")
+
+        etl.ensure_schema(conn)
+        etl.run(conn, self.drop_directory)
+
+        self.assertEqual(conn.execute("SELECT rows_rejected FROM etl_manifest").fetchall(), [(0,)])
+        conn.close()
+
+    def tearDown(self):
+        self.conn.close()
+        shutil.rmtree(self.drop_directory)
+
+
+class ReportTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        shutil.copy('retail.db', self.directory)
+        self.conn = sqlite3.connect(os.path.join(self.directory, 'retail.db'))
+        etl.ensure_schema(self.conn)
+
+    def assertSummaryMatchesTransactions(self):
+        query = "SELECT transaction_date, name, category, COUNT(*), SUM(quantity), SUM(amount_inc_tax_cents) FROM transactions GROUP BY 1, 2, 3 ORDER BY 1, 2, 3"
+        summary = "SELECT transaction_date, name, category, transactions, quantity, amount_inc_tax_cents FROM daily_summary ORDER BY 1, 2, 3"
+        self.assertEqual(self.conn.execute(summary).fetchall(), self.conn.execute(query).fetchall())
+
+    def test_summary_is_backfilled(self):
+        self.assertSummaryMatchesTransactions()
+
+    def test_reports_match_readme_queries(self):
+        counts = dict(self.conn.execute("SELECT transaction_date, COUNT(*) FROM transactions GROUP BY transaction_date"))
+        self.assertEqual(etl.transaction_counts(self.conn), counts)
+        self.assertEqual(etl.transaction_counts(self.conn)['2022-01-14'], 47)
+        self.assertAlmostEqual(etl.category_total(self.conn, 'SELL'), 360448.98, places=2)
+
+        balance = self.conn.execute("""
+            SELECT transaction_date, SUM(CASE category WHEN 'SELL' THEN amount_inc_tax ELSE -amount_inc_tax END)
+            FROM transactions WHERE name = 'Amazon Echo Dot' GROUP BY transaction_date ORDER BY transaction_date
+        """).fetchall()
+        cumulative = 0
+        for (date, value), (expected_date, expected), (cumulative_date, cumulative_value) in zip(
+            etl.balance(self.conn, 'Amazon Echo Dot'), balance, etl.cumulative_balance(self.conn, 'Amazon Echo Dot'), strict=True
+        ):
+            cumulative += expected
+            self.assertEqual((date, cumulative_date), (expected_date, expected_date))
+            self.assertAlmostEqual(value, expected, places=6)
+            self.assertAlmostEqual(cumulative_value, cumulative, places=6)
+        self.assertEqual(etl.balance(self.conn, 'Unknown product'), [])
+
+    def test_load_updates_summary_incrementally(self):
+        df = etl.transform(pd.read_csv('retail_15_01_2022.csv'), 'retail_16_01_2022.csv')
+        df = etl.pd.concat([df.assign(id=df['id'] + '-new'), df.head(5).assign(id=df['id'].head(5) + '-new')])
+
+        self.assertEqual(etl.load(df, self.conn), 54)
+        self.assertEqual(etl.load(df, self.conn), 0)
+
+        self.assertSummaryMatchesTransactions()
+        self.assertEqual(etl.transaction_counts(self.conn)['2022-01-16'], 54)
+
+    def tearDown(self):
+        self.conn.close()
+        shutil.rmtree(self.directory)
+
+
+class SchemaTest(unittest.TestCase):
+    # The README and TransactionTest queries, with the index each one must read.
+    # An index on the virtual transaction_date can't cover: matching rows are read
+    QUERIES = {
+        "SELECT COUNT(*) FROM transactions WHERE date_key = 20220114": 'COVERING INDEX transactions_date',
+        "SELECT SUM(amount_inc_tax_cents) / 100.0 FROM transactions WHERE category = 'SELL'": 'COVERING INDEX transactions_category',
+        """
+        SELECT date_key, SUM(CASE category WHEN 'SELL' THEN amount_inc_tax_cents WHEN 'BUY' THEN -amount_inc_tax_cents END) / 100.0
+        FROM transactions WHERE name = 'Amazon Echo Dot' GROUP BY date_key ORDER BY date_key
+        """: 'COVERING INDEX transactions_name',
+        """
+        SELECT date_key, SUM(SUM(CASE category WHEN 'SELL' THEN amount_inc_tax_cents WHEN 'BUY' THEN -amount_inc_tax_cents END)) OVER (ORDER BY date_key) / 100.0
+        FROM transactions WHERE name = 'Amazon Echo Dot' GROUP BY date_key ORDER BY date_key
+        """: 'COVERING INDEX transactions_name',
+        "SELECT COUNT(*) FROM transactions WHERE transaction_date = '2022-01-15'": 'INDEX transactions_transaction_date',
+    }
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        shutil.copy('retail.db', self.directory)
+        self.conn = sqlite3.connect(os.path.join(self.directory, 'retail.db'))
+        self.legacy = sqlite3.connect('retail.db')
+        etl.ensure_schema(self.conn)
+
+    def test_migration_keeps_legacy_columns(self):
+        query = "SELECT id, transaction_date, category, name, quantity, amount_excl_tax, amount_inc_tax FROM transactions ORDER BY id"
+
+        self.assertEqual(self.conn.execute(query).fetchall(), self.legacy.execute(query).fetchall())
+        self.assertEqual(self.conn.execute("PRAGMA user_version").fetchone()[0], etl.SCHEMA_VERSION)
+        types = {column[1]: column[2] for column in self.conn.execute("PRAGMA table_xinfo(transactions)")}
+        self.assertEqual((types['date_key'], types['amount_inc_tax_cents']), ('INTEGER', 'INTEGER'))
+        self.assertEqual(self.conn.execute("SELECT date_key, amount_inc_tax_cents FROM transactions WHERE id = '0284f92e-54f7-4766-880d-2cc5a8993a89'").fetchone(), (20220115, 47994))
+
+    def test_failed_migration_rolls_back(self):
+        legacy = sqlite3.connect(os.path.join(self.directory, 'legacy.db'))
+        self.legacy.backup(legacy)
+        legacy.execute("INSERT INTO transactions (id, category) VALUES ('blob', X'00')")
+        legacy.commit()
+
+        # A STRICT TEXT column refuses the BLOB
+        with self.assertRaises(sqlite3.IntegrityError):
+            etl.ensure_schema(legacy)
+        tables = [row[0] for row in legacy.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+        self.assertNotIn('transactions_typed', tables)
+        self.assertEqual(legacy.execute("PRAGMA user_version").fetchone()[0], 0)
+
+        legacy.execute("DELETE FROM transactions WHERE id = 'blob'")
+        legacy.execute("CREATE TABLE transactions_typed (id)")
+        legacy.commit()
+        etl.ensure_schema(legacy)
+        self.assertEqual(legacy.execute("SELECT COUNT(*) FROM transactions").fetchone()[0], 735)
+        self.assertEqual(legacy.execute("PRAGMA user_version").fetchone()[0], etl.SCHEMA_VERSION)
+        legacy.close()
+
+    def test_migration_from_typed_schema_keeps_rowids(self):
+        conn = sqlite3.connect(':memory:')
+        conn.execute(f"CREATE TABLE transactions ({', '.join(etl.TYPED_COLUMNS)})")
+        conn.executemany("INSERT INTO transactions (rowid, id, date_key, category, name, quantity) VALUES (?, ?, 20220115, 'SELL', 'Amazon Echo Dot', 1)", [(3, 'a'), (7, 'b')])
+        conn.execute("PRAGMA user_version = 1")
+
+        etl.ensure_schema(conn)
+
+        self.assertEqual(conn.execute("SELECT seq, id FROM transactions ORDER BY seq").fetchall(), [(3, 'a'), (7, 'b')])
+        self.assertEqual(conn.execute("PRAGMA user_version").fetchone()[0], etl.SCHEMA_VERSION)
+        df = etl.transform(pd.read_csv('retail_15_01_2022.csv'), 'retail_15_01_2022.csv')
+        etl.load(df.head(1), conn)
+        self.assertEqual(conn.execute("SELECT MAX(seq) FROM transactions").fetchone()[0], 8)
+        self.assertEqual(conn.execute("SELECT SUM(transactions) FROM daily_summary").fetchone()[0], 3)
+        conn.close()
+
+    def test_ensure_schema_is_idempotent(self):
+        summary = self.conn.execute("SELECT * FROM daily_summary").fetchall()
+
+        etl.ensure_schema(self.conn)
+
+        self.assertEqual(self.conn.execute("SELECT * FROM daily_summary").fetchall(), summary)
+        self.assertEqual(self.conn.execute("SELECT COUNT(*) FROM transactions").fetchone()[0], 735)
+
+    def count(self, condition):
+        return self.conn.execute(f"SELECT COUNT(*) FROM transactions WHERE {condition}").fetchone()[0]
+
+    def test_typed_columns_hold_valid_values(self):
+        # TransactionTest checks, as single queries over the migrated table
+        self.assertEqual(self.count("quantity IS NULL OR NOT quantity > 0"), 0)
+        self.assertEqual(self.count("category IS NULL OR category NOT IN ('SELL', 'BUY')"), 0)
+        # strftime() returns NULL for invalid dates, and normalises them otherwise
+        self.assertEqual(self.count("strftime('%Y-%m-%d', transaction_date) IS NOT transaction_date"), 0)
+        self.assertEqual(self.count("name = ''"), 0)
+        self.assertEqual(self.count("NOT amount_excl_tax > 0 OR NOT amount_inc_tax > 0"), 0)
+
+    def test_queries_use_indexes(self):
+        for query, index in self.QUERIES.items():
+            plan = ' '.join(step[-1] for step in self.conn.execute(f"EXPLAIN QUERY PLAN {query}"))
+            self.assertIn(f"USING {index} ", plan)
+            self.assertNotIn("SCAN transactions", plan)
+
+    def test_readme_answers(self):
+        queries = list(self.QUERIES)
+
+        self.assertEqual(self.conn.execute(queries[0]).fetchone()[0], 47)
+        self.assertEqual(self.conn.execute(queries[1]).fetchone()[0], 360448.98)
+        self.assertEqual(self.conn.execute(queries[3]).fetchall()[-1], (20220115, 89.99))
+        self.assertEqual(self.conn.execute(queries[4]).fetchone()[0], 54)
+
+    def tearDown(self):
+        self.conn.close()
+        self.legacy.close()
+        shutil.rmtree(self.directory)
+
+
+class BackendTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        shutil.copy('retail_15_01_2022.csv', self.directory)
+        self.database = os.path.join(self.directory, 'retail.db')
+
+    def test_open_backend(self):
+        self.assertEqual(etl.open_backend(f'sqlite:///{self.database}').database, self.database)
+        self.assertEqual(etl.open_backend(self.database, synchronous='FULL').synchronous, 'FULL')
+        self.assertIsInstance(etl.open_backend('postgresql://user@localhost/retail'), etl.PostgresBackend)
+        with self.assertRaises(ValueError):
+            etl.open_backend('mysql://user@localhost/retail')
+        with self.assertRaises(TypeError):
+            etl.Backend()
+
+    def test_connection_pool(self):
+        backend = etl.SQLiteBackend(self.database, pool_size=1)
+        with backend.connection() as conn, backend.connection() as other:
+            self.assertIsNot(conn, other)
+        # Only one of them was kept
+        with backend.connection() as reused:
+            self.assertIn(reused, (conn, other))
+        with self.assertRaises(sqlite3.ProgrammingError):
+            (other if reused is conn else conn).execute("SELECT 1")
+        backend.close()
+        with self.assertRaises(sqlite3.ProgrammingError):
+            reused.execute("SELECT 1")
+
+    def test_connection_rolls_back_on_error(self):
+        backend = etl.SQLiteBackend(self.database)
+        with backend.connection() as conn:
+            backend.ensure_schema(conn)
+        with self.assertRaises(RuntimeError), backend.connection() as conn:
+            backend.load(etl.transform(pd.read_csv('retail_15_01_2022.csv'), 'retail_15_01_2022.csv'), conn)
+            raise RuntimeError
+        with backend.connection() as conn:
+            self.assertEqual(conn.execute("SELECT COUNT(*) FROM transactions").fetchone()[0], 0)
+        backend.close()
+
+    def test_main_with_database_url(self):
+        with mock.patch.dict(os.environ, {etl.DATABASE_URL_VARIABLE: f'sqlite:///{self.database}'}), mock.patch.object(etl, 'run_parallel') as run_parallel:
+            etl.main(['--drop-dir', self.directory])
+        # Files are streamed chunk by chunk unless --workers asks for the pool
+        run_parallel.assert_not_called()
+
+        conn = sqlite3.connect(self.database)
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM transactions").fetchone()[0], 54)
+        conn.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+@unittest.skipIf(etl.psycopg is None, "needs psycopg")
+class PostgresBackendTest(unittest.TestCase):
+    # Runs against RETAIL_TEST_DATABASE_URL, a disposable database, or else a
+    # throwaway server started with pgserver
+    @classmethod
+    def setUpClass(cls):
+        cls.server = None
+        url = os.environ.get('RETAIL_TEST_DATABASE_URL')
+        if url is None:
+            if pgserver is None:
+                raise unittest.SkipTest("needs RETAIL_TEST_DATABASE_URL or pgserver")
+            cls.server_directory = tempfile.mkdtemp()
+            cls.server = pgserver.get_server(cls.server_directory, cleanup_mode='delete')
+            url = cls.server.get_uri()
+        cls.backend = etl.open_backend(url)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.backend.close()
+        if cls.server is not None:
+            cls.server.cleanup()
+            shutil.rmtree(cls.server_directory, ignore_errors=True)
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        shutil.copy('retail_15_01_2022.csv', self.directory)
+        with self.backend.connection() as conn:
+            for table in ('transactions', 'daily_summary', 'quarantine', 'etl_manifest'):
+                conn.execute(f"DROP TABLE IF EXISTS {table}")
+            self.backend.ensure_schema(conn)
+
+    def test_run(self):
+        backend = self.backend
+        with open(os.path.join(self.directory, 'retail_14_01_2022.csv'), 'w') as f:
+            f.write("id,category,description,quantity,amount_excl_tax,amount_inc_tax\n")
+            f.write("new-id,SELL,Amazon Echo Dot,1,24.99,29.99\n")
+            f.write("invalid-id,SELL,Amazon Echo Dot,-1,24.99,29.99\n")
+        with backend.connection() as conn:
+            entries = etl.run(conn, self.directory, backend=backend)
+
+            self.assertEqual([(entry['rows_inserted'], entry['rows_rejected']) for entry in entries], [(1, 1), (54, 0)])
+            self.assertEqual(etl.run(conn, self.directory, backend=backend), [])
+            self.assertEqual(conn.execute("SELECT COUNT(*), SUM(amount_inc_tax_cents) FROM transactions WHERE transaction_date = '2022-01-14'").fetchone(), (1, 2999))
+            self.assertEqual(conn.execute("SELECT SUM(transactions) FROM daily_summary").fetchone()[0], 55)
+            self.assertEqual(conn.execute("SELECT id, reason FROM quarantine").fetchall(), [('invalid-id', 'non_positive_quantity')])
+
+    def test_typed_columns_match_sqlite(self):
+        with open(os.path.join(self.directory, 'retail_14_01_2022.csv'), 'w') as f:
+            f.write("id,category,description,quantity,amount_excl_tax,amount_inc_tax\n")
+            f.write("half,SELL,Amazon Echo Dot,1.5,24.99,29.99\n")
+            f.write("sub-cent,SELL,Amazon Echo Dot,1,1.005,1.21\n")
+        sqlite_conn = sqlite3.connect(':memory:')
+        etl.ensure_schema(sqlite_conn)
+        etl.run(sqlite_conn, self.directory)
+        query = "SELECT id, date_key, quantity, amount_excl_tax_cents, amount_inc_tax_cents FROM transactions ORDER BY id"
+        with self.backend.connection() as conn:
+            etl.run(conn, self.directory, backend=self.backend)
+
+            self.assertEqual(conn.execute(query).fetchall(), sqlite_conn.execute(query).fetchall())
+            quarantined = "SELECT id, reason FROM quarantine ORDER BY id"
+            self.assertEqual(conn.execute(quarantined).fetchall(), [('half', 'fractional_quantity'), ('sub-cent', 'sub_cent_amount_excl_tax')])
+            self.assertEqual(sqlite_conn.execute(quarantined).fetchall(), conn.execute(quarantined).fetchall())
+        sqlite_conn.close()
+
+    def test_run_parallel_matches_summary(self):
+        df = pd.read_csv('retail_15_01_2022.csv')
+        df.assign(id=df['id'] + '-16').to_csv(os.path.join(self.directory, 'retail_16_01_2022.csv'), index=False)
+        with self.backend.connection() as conn:
+            entries = etl.run_parallel(conn, self.directory, workers=2, batch_rows=60, backend=self.backend)
+
+            self.assertEqual([entry['rows_inserted'] for entry in entries], [54, 54])
+            summary = conn.execute("""
+                SELECT date_key, name, category, transactions, quantity, amount_inc_tax_cents FROM daily_summary ORDER BY 1, 2, 3
+            """).fetchall()
+            expected = conn.execute("""
+                SELECT date_key, name, category, COUNT(*), SUM(quantity), SUM(amount_inc_tax_cents) FROM transactions GROUP BY 1, 2, 3 ORDER BY 1, 2, 3
+            """).fetchall()
+            self.assertEqual(summary, expected)
+            self.assertEqual(len(summary), 2 * len(df.groupby(['description', 'category'])))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+class WatchTest(unittest.TestCase):
+    def setUp(self):
+        self.conn = sqlite3.connect(':memory:')
+        etl.ensure_schema(self.conn)
+        self.drop_directory = tempfile.mkdtemp()
+        self.metrics = io.StringIO()
+
+    def events(self):
+        return [json.loads(line) for line in self.metrics.getvalue().splitlines()]
+
+    def test_watch_coalesces_files_into_one_batch(self):
+        shutil.copy('retail_15_01_2022.csv', self.drop_directory)
+        with open(os.path.join(self.drop_directory, 'retail_14_01_2022.csv'), 'w') as f:
+            f.write("id,category,description,quantity,amount_excl_tax,amount_inc_tax\n")
+            f.write("new-id,SELL,Amazon Echo Dot,1,24.99,29.99\n")
+
+        entries = etl.watch(self.conn, self.drop_directory, poll_interval=0.01, batch_window=0, max_batches=1, metrics=self.metrics)
+
+        self.assertEqual([entry['file_name'] for entry in entries], ['retail_14_01_2022.csv', 'retail_15_01_2022.csv'])
+        self.assertTrue(all(entry['latency_seconds'] > 0 for entry in entries))
+        batch, summary = self.events()
+        self.assertEqual((batch['event'], batch['rows_inserted'], len(batch['latency_seconds'])), ('batch', 55, 2))
+        self.assertEqual((summary['event'], summary['batches'], summary['files']), ('summary', 1, 2))
+        self.assertEqual(self.conn.execute("SELECT COUNT(*) FROM transactions").fetchone()[0], 55)
+
+    def test_watch_skips_failing_files(self):
+        with open(os.path.join(self.drop_directory, 'retail_13_01_2022.csv'), 'wb') as f:
+            f.write(b"\xff\xfe\x00")
+        shutil.copy('retail_15_01_2022.csv', self.drop_directory)
+
+        entries = etl.watch(self.conn, self.drop_directory, poll_interval=0.01, batch_window=0, max_batches=1, metrics=self.metrics)
+
+        self.assertEqual([entry['file_name'] for entry in entries], ['retail_15_01_2022.csv'])
+        self.assertEqual([event['event'] for event in self.events()], ['error', 'batch', 'summary'])
+        self.assertEqual(self.events()[0]['file'], 'retail_13_01_2022.csv')
+
+    def test_watch_reports_files_failing_the_scan(self):
+        shutil.copy('retail_15_01_2022.csv', self.drop_directory)
+        shutil.copy('retail_15_01_2022.csv', os.path.join(self.drop_directory, 'retail_31_02_2022.csv'))
+        # Removed between the listing and its stat
+        gone = os.path.join(self.drop_directory, 'retail_16_01_2022.csv')
+        pending_files = etl.pending_files
+
+        with mock.patch.object(etl, 'pending_files', lambda *args, **kwargs: pending_files(*args, **kwargs) + [gone]):
+            entries = etl.watch(self.conn, self.drop_directory, poll_interval=0.01, batch_window=0, max_batches=1, metrics=self.metrics)
+
+        self.assertEqual([entry['file_name'] for entry in entries], ['retail_15_01_2022.csv'])
+        events = self.events()
+        self.assertEqual([event['event'] for event in events], ['error', 'error', 'batch', 'summary'])
+        self.assertEqual({event['file'] for event in events[:2]}, {'retail_31_02_2022.csv', 'retail_16_01_2022.csv'})
+
+    def test_latency_summary(self):
+        self.assertEqual(etl.latency_summary([]), {'files': 0})
+        self.assertEqual(etl.latency_summary([3, 1, 2]), {'files': 3, 'p50_seconds': 2, 'p95_seconds': 2, 'max_seconds': 3})
+
+    def tearDown(self):
+        self.conn.close()
+        shutil.rmtree(self.drop_directory)
+
+
+@unittest.skipIf(etl.ds is None, "needs pyarrow")
+class ArchiveTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        shutil.copy('retail.db', self.directory)
+        self.archive_directory = os.path.join(self.directory, 'archive')
+        self.drop_directory = os.path.join(self.directory, 'drop')
+        os.mkdir(self.drop_directory)
+        self.backend = etl.SQLiteBackend(os.path.join(self.directory, 'retail.db'), archive_directory=self.archive_directory)
+        self.conn = self.backend.connect()
+        self.backend.ensure_schema(self.conn)
+
+    def test_archive_is_appended_after_each_load(self):
+        self.assertEqual(etl.archive(self.conn, self.archive_directory), 735)
+        files = {os.path.relpath(os.path.join(root, name), self.archive_directory) for root, dirs, names in os.walk(self.archive_directory) for name in names}
+        self.assertEqual(len(os.listdir(self.archive_directory)), 15 + 1)
+
+        df = etl.pd.read_csv('retail_15_01_2022.csv')
+        df.assign(id=df['id'] + '-16').to_csv(os.path.join(self.drop_directory, 'retail_16_01_2022.csv'), index=False)
+        etl.run(self.conn, self.drop_directory, backend=self.backend)
+
+        new_files = {os.path.relpath(os.path.join(root, name), self.archive_directory) for root, dirs, names in os.walk(self.archive_directory) for name in names}
+        self.assertTrue(files < new_files)
+        self.assertTrue(all(name.startswith('transaction_date=2022-01-16') for name in new_files - files - {etl.ARCHIVE_WATERMARK}))
+        self.assertEqual(etl.archive(self.conn, self.archive_directory), 0)
+        self.assertEqual(etl.archive_dataset(self.archive_directory).count_rows(), 735 + 54)
+
+    def test_archive_retry_after_crash(self):
+        replace, calls = os.replace, []
+
+        # The process dies after writing the second chunk, before its watermark
+        def crashing_replace(*args):
+            calls.append(args)
+            if len(calls) == 2:
+                raise RuntimeError
+            replace(*args)
+
+        with mock.patch.object(etl.os, 'replace', crashing_replace), self.assertRaises(RuntimeError):
+            etl.archive(self.conn, self.archive_directory, chunk_rows=300)
+        self.assertEqual(etl.archive_dataset(self.archive_directory).count_rows(), 600)
+
+        # The retry may read larger chunks, its first one starts at the same seq
+        self.assertEqual(etl.archive(self.conn, self.archive_directory, chunk_rows=1000), 735 - 300)
+        self.assertEqual(etl.archive_dataset(self.archive_directory).count_rows(), 735)
+        self.assertEqual(etl.archive_category_total(self.archive_directory, 'SELL'), etl.category_total(self.conn, 'SELL'))
+
+    def test_archive_after_vacuum(self):
+        self.assertEqual(etl.archive(self.conn, self.archive_directory), 735)
+        # VACUUM may renumber implicit rowids once rows are deleted
+        self.conn.execute("DELETE FROM transactions WHERE seq IN (SELECT seq FROM transactions ORDER BY seq LIMIT 100)")
+        self.conn.commit()
+        self.conn.execute("VACUUM")
+        df = etl.pd.read_csv('retail_15_01_2022.csv')
+        df.assign(id=df['id'] + '-16').to_csv(os.path.join(self.drop_directory, 'retail_16_01_2022.csv'), index=False)
+        etl.run(self.conn, self.drop_directory)
+
+        self.assertEqual(etl.archive(self.conn, self.archive_directory), 54)
+        self.assertEqual(etl.archive_dataset(self.archive_directory).count_rows(), 735 + 54)
+
+    def test_archive_resumes_from_legacy_watermark(self):
+        # The migration kept the rowids the legacy watermark refers to as seqs
+        archived_seq = self.conn.execute("SELECT seq FROM transactions ORDER BY seq LIMIT 1 OFFSET 299").fetchone()[0]
+        os.mkdir(self.archive_directory)
+        with open(os.path.join(self.archive_directory, etl.LEGACY_ARCHIVE_WATERMARK), 'w') as f:
+            f.write(str(archived_seq))
+
+        self.assertEqual(etl.archive(self.conn, self.archive_directory), 735 - 300)
+        with open(os.path.join(self.archive_directory, etl.ARCHIVE_WATERMARK)) as f:
+            self.assertEqual(int(f.read()), self.conn.execute("SELECT MAX(seq) FROM transactions").fetchone()[0])
+
+    def test_archive_reports_match_database(self):
+        etl.archive(self.conn, self.archive_directory, chunk_rows=100)
+
+        self.assertEqual(etl.archive_category_total(self.archive_directory, 'SELL'), etl.category_total(self.conn, 'SELL'))
+        self.assertEqual(etl.archive_balance(self.archive_directory, 'Amazon Echo Dot'), etl.balance(self.conn, 'Amazon Echo Dot'))
+        self.assertEqual(etl.archive_cumulative_balance(self.archive_directory, 'Amazon Echo Dot'), etl.cumulative_balance(self.conn, 'Amazon Echo Dot'))
+        self.assertEqual(etl.archive_balance(self.archive_directory, 'Unknown product'), [])
+
+    def tearDown(self):
+        self.conn.close()
+        shutil.rmtree(self.directory)
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
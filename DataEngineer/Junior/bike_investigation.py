@@ -1,36 +1,187 @@
 import numpy as np
 import pandas as pd
 import inquirer
-import time, os, calendar
+import time, os, sys, calendar, glob, json, pickle, shutil, tempfile
+import contextlib, cProfile, functools, inspect, resource, tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.feather as feather
+except ImportError:
+    # Without pyarrow, the city CSV is parsed on every load
+    pa = pc = feather = None
 
 current_directory = os.getcwd()
+CACHE_DIRECTORY = os.path.join(current_directory, ".cache")
 
 CITY_DATA = {
     "chicago": os.path.join(current_directory, "chicago.csv"),
     "new york city": os.path.join(current_directory, "new_york_city.csv"),
     "washington": os.path.join(current_directory, "washington.csv"),
 }
-# Not very usefull but still cool to defined the data types
+# Compact types of the CSV columns: the repeated strings as categories and the
+# numbers on as few bytes as their range needs, NA marking a missing birth year
 DTYPES = {
-    'Trip Duration': np.float64,
-    'Start Station': str,
-    'End Station': str,
-    'User Type': str,
-    'Gender': str,
-    'Birth Year': np.float64,
+    'Trip Duration': np.float32,
+    'Start Station': 'category',
+    'End Station': 'category',
+    'User Type': 'category',
+    'Gender': 'category',
+    'Birth Year': 'Int16',
 }
+# Small-int columns derived from 'Start Time' on load, with the datetime field
+# they hold and their value for trips without a valid date
+TIME_COLUMNS = {
+    'Start Month': ('month', 0),
+    'Start Weekday': ('weekday', 7),
+    'Start Hour': ('hour', 24),
+}
+# Columns read by each stats function, the only ones main() loads
+STATS_COLUMNS = {
+    "time_stats": list(TIME_COLUMNS),
+    "station_stats": ['Start Station', 'End Station'],
+    "trip_duration_stats": ['Trip Duration'],
+    "user_stats": ['User Type', 'Gender', 'Birth Year'],
+}
+CSV_CHUNK_ROWS = 100_000
+CUBE_FILE = "cube.pickle"
+# Part of the cache directory names, to be increased whenever the cached columns change
+CACHE_VERSION = 2
+# Filter choices of get_filters
+MONTHS = ["all"] + [month.lower() for month in calendar.month_name[1:]]
+DAYS = ["all"] + [day.lower() for day in calendar.day_name]
 VALID_GENDERS = ["Male", "Female"]
 VALID_USER_TYPES = ["Subscriber", "Customer"]
+# JSON lines file the stage metrics are appended to, stderr when unset
+METRICS_FILE = os.environ.get("BIKESHARE_METRICS")
+# Profiler run around each outermost stage: "cprofile", "tracemalloc", or unset for none
+PROFILER = os.environ.get("BIKESHARE_PROFILER")
+PROFILE_DIRECTORY = os.path.join(current_directory, ".profiles")
+# Running stages of this process, innermost last
+STAGES = []
+
+def peak_rss() -> int:
+    """Returns the peak resident memory of the process so far, in bytes."""
+    # ru_maxrss is in kilobytes on Linux, in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+def emit_metric(metric: dict) -> None:
+    """Writes a metric as one JSON line to METRICS_FILE, or to stderr."""
+    line = json.dumps(metric)
+    if METRICS_FILE is None:
+        print(line, file=sys.stderr, flush=True)
+    else:
+        with open(METRICS_FILE, "a") as f:
+            f.write(line + "\n")
+
+def count_rows(rows_in: int = 0, rows_out: int = 0) -> None:
+    """Adds rows read and rows kept to the innermost running stage, if any."""
+    if STAGES:
+        metric = STAGES[-1]["metric"]
+        metric["rows_in"] = (metric["rows_in"] or 0) + rows_in
+        metric["rows_out"] = (metric["rows_out"] or 0) + rows_out
+
+def fold_traced_peak(frame: dict | None) -> None:
+    """
+    Moves the traced memory peak since the last reset into frame, so that
+    every running stage keeps its own peak while nested stages reset it.
+    """
+    if frame is not None:
+        frame["traced_peak"] = max(frame["traced_peak"], tracemalloc.get_traced_memory()[1])
+    tracemalloc.reset_peak()
+
+@contextlib.contextmanager
+def stage(name: str, **fields):
+    """
+    Measures the block as a stage, then emits its metrics with emit_metric:
+    elapsed_ns from perf_counter_ns, peak_rss_delta (bytes the block added
+    to the process peak resident memory), rows_in and rows_out (set on the
+    yielded metric, or counted with count_rows), and traced_peak_delta
+    (bytes allocated at the peak of the block) when tracemalloc is tracing.
 
-def time_execution(func):
+    With PROFILER set, the outermost stage also runs under cProfile, or
+    under tracemalloc, and dumps the profile or snapshot to
+    PROFILE_DIRECTORY, its path being the "profile" of the metric.
+
+    Args:
+        (str) name - name of the stage
+        fields - other values reported in the metric
+    """
+    parent = STAGES[-1] if STAGES else None
+    profiler = None
+    if parent is None and PROFILER == "cprofile":
+        profiler = cProfile.Profile()
+    elif parent is None and PROFILER == "tracemalloc" and not tracemalloc.is_tracing():
+        profiler = tracemalloc
+        tracemalloc.start()
+
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        fold_traced_peak(parent)
+    metric = {
+        "stage": name, "parent": parent["metric"]["stage"] if parent else None, **fields,
+        "pid": os.getpid(), "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"), "rows_in": None, "rows_out": None,
+    }
+    frame = {"metric": metric, "traced_peak": 0}
+    STAGES.append(frame)
+    traced_start = tracemalloc.get_traced_memory()[0] if tracing else 0
+    rss_start = peak_rss()
+    if isinstance(profiler, cProfile.Profile):
+        profiler.enable()
+    start = time.perf_counter_ns()
+    try:
+        yield metric
+    except BaseException as error:
+        metric["error"] = type(error).__name__
+        raise
+    finally:
+        metric["elapsed_ns"] = time.perf_counter_ns() - start
+        if isinstance(profiler, cProfile.Profile):
+            profiler.disable()
+        metric["peak_rss_delta"] = peak_rss() - rss_start
+        STAGES.pop()
+        if tracing:
+            fold_traced_peak(frame)
+            metric["traced_peak_delta"] = frame["traced_peak"] - traced_start
+            if parent is not None:
+                parent["traced_peak"] = max(parent["traced_peak"], frame["traced_peak"])
+        if profiler is not None:
+            os.makedirs(PROFILE_DIRECTORY, exist_ok=True)
+            profile_path = os.path.join(PROFILE_DIRECTORY, f"{name}.{os.getpid()}.{time.time_ns()}")
+            if profiler is tracemalloc:
+                profile_path += ".tracemalloc"
+                tracemalloc.take_snapshot().dump(profile_path)
+                tracemalloc.stop()
+            else:
+                profile_path += ".prof"
+                profiler.dump_stats(profile_path)
+            metric["profile"] = profile_path
+        emit_metric(metric)
+
+def instrument(func):
+    """
+    Runs every call of func as a stage named after it (see stage), reporting
+    its str and number arguments, the rows of a DataFrame first argument as
+    rows_in and the rows of a DataFrame result as rows_out.
+    """
+    signature = inspect.signature(func)
+
+    @functools.wraps(func)
     def wrapper(*args, **kwargs):
-        start_time = time.time()
-        result = func(*args, **kwargs)
-        end_time = time.time()
-        execution_time = end_time - start_time
-        print("\nThis took %s seconds." % (time.time() - start_time))
-        print("-" * 40)
-        return result
+        arguments = signature.bind(*args, **kwargs).arguments
+        scalars = {key: value for key, value in arguments.items() if isinstance(value, (str, int, float))}
+        with stage(func.__name__, arguments=scalars) as metric:
+            first = next(iter(arguments.values()), None)
+            if isinstance(first, pd.DataFrame):
+                metric["rows_in"] = len(first)
+            result = func(*args, **kwargs)
+            if isinstance(result, pd.DataFrame):
+                metric["rows_out"] = len(result)
+            return result
     return wrapper
 
 def get_filters() -> tuple:
@@ -38,7 +189,7 @@ def get_filters() -> tuple:
     Asks user to specify a city, month, and day to analyze.
 
     Returns:
-        (str) city - name of the city to analyze
+        (str) city - name of the city to analyze, or "all" to compare every city
         (str) month - name of the month to filter by, or "all" to apply no month filter
         (str) day - name of the day of week to filter by, or "all" to apply no day filter
     """
@@ -48,7 +199,7 @@ def get_filters() -> tuple:
     city_question = [
     inquirer.List('city',
                     message="Which city would you like to explore ?",
-                    choices=['chicago', 'new york city', 'washington'],
+                    choices=['chicago', 'new york city', 'washington', 'all'],
                 ),
     ]
     city = inquirer.prompt(city_question)["city"]
@@ -76,7 +227,163 @@ def get_filters() -> tuple:
     return city, month, day
 
 
-def load_data(city: str, month: str, day: str) -> pd.DataFrame:
+def city_columns(city: str) -> list:
+    """Returns the column names of the city CSV, without parsing its rows."""
+    return pd.read_csv(CITY_DATA[city], nrows=0).columns.tolist()
+
+def iter_city_csv(city: str, month: int | None = None, weekday: int | None = None, columns: list | None = None, chunk_rows: int = CSV_CHUNK_ROWS):
+    """
+    Reads a city CSV lazily, chunk_rows rows at a time, and yields each chunk
+    with only the rows and columns asked for.
+
+    Args:
+        (str) city - name of the city to read
+        (int) month - month number to keep (1 = January), or None to keep every month
+        (int) weekday - day of week to keep (0 = Monday), or None to keep every day
+        (list) columns - columns to return, or None to return every column
+        (int) chunk_rows - number of CSV rows parsed at once
+    """
+    filtered = month is not None or weekday is not None
+    usecols = None
+    if columns is not None:
+        wanted = set(columns) | ({'Start Time'} if filtered or set(columns) & set(TIME_COLUMNS) else set())
+        usecols = [column for column in city_columns(city) if column in wanted]
+    parse_dates = [column for column in ['Start Time', 'End Time'] if usecols is None or column in usecols]
+
+    for chunk in pd.read_csv(CITY_DATA[city], dtype=DTYPES, parse_dates=parse_dates, usecols=usecols, chunksize=chunk_rows):
+        rows_in = len(chunk)
+        chunk = add_time_columns(chunk)
+        if month is not None:
+            chunk = chunk[chunk['Start Month'] == month]
+        if weekday is not None:
+            chunk = chunk[chunk['Start Weekday'] == weekday]
+        count_rows(rows_in, len(chunk))
+        yield chunk if columns is None else chunk[[column for column in chunk.columns if column in columns]]
+
+def read_city_csv(city: str, month: int | None = None, weekday: int | None = None, columns: list | None = None) -> pd.DataFrame:
+    """
+    Reads a city CSV in chunks of CSV_CHUNK_ROWS rows, keeping only the rows
+    and columns asked for, so memory scales with the selected slice.
+
+    Args:
+        (str) city - name of the city to read
+        (int) month - month number to keep (1 = January), or None to keep every month
+        (int) weekday - day of week to keep (0 = Monday), or None to keep every day
+        (list) columns - columns to return, or None to return every column
+    Returns:
+        df - Pandas DataFrame containing the selected rows and columns
+    """
+    return concat_trips(list(iter_city_csv(city, month, weekday, columns)))
+
+def add_time_columns(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Adds to trips read from a city CSV the TIME_COLUMNS derived from their
+    'Start Time', so that filters and stats never parse the dates again.
+    The DataFrame is modified in place and returned.
+    """
+    if 'Start Time' in df.columns:
+        start_time = pd.to_datetime(df['Start Time'], format='%Y-%m-%d %H:%M:%S', errors='coerce')
+        for column, (field, missing) in TIME_COLUMNS.items():
+            df[column] = getattr(start_time.dt, field).fillna(missing).astype(np.int8)
+    return df
+
+def concat_trips(chunks: list) -> pd.DataFrame:
+    """
+    Concatenates chunks of trips, giving each categorical column the union of
+    its categories in every chunk first, as pandas would otherwise fall back
+    to Python strings for the columns whose categories differ.
+    """
+    for column in chunks[0].columns:
+        if isinstance(chunks[0][column].dtype, pd.CategoricalDtype):
+            categories = chunks[0][column].cat.categories.append([chunk[column].cat.categories for chunk in chunks[1:]]).unique()
+            chunks = [chunk.assign(**{column: chunk[column].cat.set_categories(categories)}) for chunk in chunks]
+    return pd.concat(chunks)
+
+def city_cache(city: str) -> str:
+    """
+    Returns the cache directory of a city, building it first if needed.
+
+    The parsed city data is stored as one uncompressed Feather (Arrow IPC)
+    file per month of 'Start Time' (month=00 holding the rows without a valid
+    date), so reads can skip the months they don't need and memory-map the
+    others. The directory name carries the size and modification time of the
+    source CSV, so any change to the CSV invalidates it.
+    """
+    source = CITY_DATA[city]
+    stat = os.stat(source)
+    name = os.path.splitext(os.path.basename(source))[0]
+    cache_path = os.path.join(CACHE_DIRECTORY, f"{name}.{stat.st_size}-{stat.st_mtime_ns}-v{CACHE_VERSION}")
+    if os.path.isdir(cache_path):
+        return cache_path
+
+    with stage("parse_city_csv", arguments={"city": city}) as metric:
+        df = add_time_columns(pd.read_csv(source, dtype=DTYPES, parse_dates=['Start Time', 'End Time']))
+        metric["rows_in"] = metric["rows_out"] = len(df)
+    os.makedirs(CACHE_DIRECTORY, exist_ok=True)
+    for stale_path in glob.glob(os.path.join(CACHE_DIRECTORY, f"{glob.escape(name)}.*-*")):
+        shutil.rmtree(stale_path, ignore_errors=True)
+    # Written under a temporary name first so a concurrent reader never sees a partial cache
+    temporary_path = tempfile.mkdtemp(prefix=f"{name}.", dir=CACHE_DIRECTORY)
+    for month, partition in df.groupby('Start Month'):
+        # The index is kept to restore the CSV row order and labels when months are combined
+        table = pa.Table.from_pandas(partition, preserve_index=True)
+        feather.write_feather(table, os.path.join(temporary_path, f"month={month:02d}.feather"), compression="uncompressed")
+    try:
+        os.rename(temporary_path, cache_path)
+    except OSError:
+        # Another process built the same cache meanwhile
+        shutil.rmtree(temporary_path, ignore_errors=True)
+    return cache_path
+
+def read_city(city: str, month: int | None = None, weekday: int | None = None, columns: list | None = None) -> pd.DataFrame:
+    """
+    Reads the data of a city, pushing the month and day filters and the column
+    selection down into the read: through the month-partitioned Arrow cache
+    when pyarrow is installed, through a chunked CSV reader otherwise.
+
+    Args:
+        (str) city - name of the city to read
+        (int) month - month number to keep (1 = January), or None to keep every month
+        (int) weekday - day of week to keep (0 = Monday), or None to keep every day
+        (list) columns - columns to return, or None to return every column
+    Returns:
+        df - Pandas DataFrame containing the selected rows and columns
+    """
+    if feather is None:
+        return read_city_csv(city, month, weekday, columns)
+
+    cache_path = city_cache(city)
+    partitions = sorted(glob.glob(os.path.join(cache_path, "month=*.feather")))
+    if not partitions:
+        return read_city_csv(city, month, weekday, columns)
+    if month is not None:
+        selected = [path for path in partitions if os.path.basename(path) == f"month={month:02d}.feather"]
+        # A month without any trip still needs the schema of the others
+        partitions, empty = (selected, False) if selected else (partitions[:1], True)
+    else:
+        empty = False
+
+    tables = []
+    for path in partitions:
+        if columns is not None or weekday is not None:
+            available = pa.ipc.open_file(pa.memory_map(path)).schema.names
+            wanted = (set(columns) if columns is not None else set(available)) | {'Start Weekday', '__index_level_0__'}
+            table = feather.read_table(path, columns=[name for name in available if name in wanted], memory_map=True)
+        else:
+            table = feather.read_table(path, memory_map=True)
+        count_rows(0 if empty else table.num_rows)
+        if weekday is not None:
+            table = table.filter(pc.equal(table['Start Weekday'], weekday))
+        tables.append(table.slice(0, 0) if empty else table)
+
+    df = pa.concat_tables(tables).to_pandas()
+    if len(tables) > 1:
+        df = df.sort_index()
+    df.index.name = None
+    return df if columns is None else df[[column for column in df.columns if column in columns]]
+
+@instrument
+def load_data(city: str, month: str, day: str, columns: list | None = None) -> pd.DataFrame:
     """
     Loads data for the specified city and filters by month and day if applicable.
 
@@ -84,161 +391,435 @@ def load_data(city: str, month: str, day: str) -> pd.DataFrame:
         (str) city - name of the city to analyze
         (str) month - name of the month to filter by, or "all" to apply no month filter
         (str) day - name of the day of week to filter by, or "all" to apply no day filter
+        (list) columns - columns to load (see STATS_COLUMNS), or None to load every column
     Returns:
         df - Pandas DataFrame containing city data filtered by month and day
     """
+    return read_city(city, *filter_numbers(month, day), columns)
 
-    df = pd.read_csv(CITY_DATA[city], dtype=DTYPES, parse_dates=['Start Time', 'End Time'])
-
-    if month != 'all':
-        month = list(calendar.month_name).index(month.title())
-        df = df[df['Start Time'].dt.month == month]
-
-    if day != 'all':
-        df = df[df['Start Time'].dt.day_name() == day.title()]
+def filter_numbers(month: str, day: str) -> tuple:
+    """Returns the month number (1 = January) and weekday (0 = Monday) of a filter choice, None for "all"."""
+    month = None if month == 'all' else list(calendar.month_name).index(month.title())
+    weekday = None if day == 'all' else list(calendar.day_name).index(day.title())
+    return month, weekday
 
-    return df
+def validate_address(value) -> bool:
+    # we can imagine Nominatim API to validate the address
+    return isinstance(value, str) and bool(value.strip())
 
-@time_execution
-def time_stats(df: pd.DataFrame) -> dict:
-    """Displays statistics on the most frequent times of travel."""
+def validate_value(valid_values: list):
+    return lambda value: isinstance(value, str) and value in valid_values
 
-    print("\nCalculating The Most Frequent Times of Travel...\n")
-    start_time = time.time()
-    results = {}
+def value_codes(series: pd.Series, validate) -> tuple:
+    """
+    Encodes a column as integer codes, validating each distinct value once.
 
-    if df.empty or 'Start Time' not in df.columns:
-        print("The DataFrame is empty or missing 'Start Time' column.")
-        return results
+    Args:
+        (pd.Series) series - column to encode
+        (function) validate - tells whether a distinct value is kept
+    Returns:
+        (np.ndarray) codes - code of each row in uniques, -1 for missing or invalid values
+        (list) uniques - distinct values, in order of first appearance
+    """
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        # A categorical column already holds its codes
+        codes, uniques = series.cat.codes.to_numpy(), series.cat.categories
+    else:
+        try:
+            codes, uniques = pd.factorize(series)
+        except TypeError:
+            # Unhashable values (dict, list...) can't be valid anyway
+            codes, uniques = pd.factorize(series.where(series.map(lambda value: isinstance(value, str))))
+    uniques = list(uniques)
+    keep = np.array([validate(value) for value in uniques] + [False], dtype=bool)
+    return np.where(keep[codes], codes, -1), uniques
+
+def code_counts(codes: np.ndarray, uniques: list) -> pd.Series:
+    """Counts the rows of each valid code, as a Series indexed by value."""
+    counts = np.bincount(codes[codes >= 0], minlength=len(uniques))
+    return pd.Series(counts, index=pd.Index(uniques, dtype=object), dtype=np.int64)[counts > 0]
+
+def has_start_time(columns) -> bool:
+    """Tells whether columns hold 'Start Time', or the TIME_COLUMNS derived from it."""
+    return 'Start Time' in columns or all(column in columns for column in TIME_COLUMNS)
+
+def stats_state(df: pd.DataFrame, parts: tuple = tuple(STATS_COLUMNS)) -> dict:
+    """
+    Computes in a single pass the aggregates every stats function is derived
+    from: counts per month, day of week, hour, station, trip, user type and
+    gender, trip duration sum and count, and earliest birth year.
 
-    df['Start Time'] = pd.to_datetime(df['Start Time'], format='%Y-%m-%d %H:%M:%S', errors='coerce')
-    df['Start Time'] = df['Start Time'].dropna()
+    Args:
+        (pd.DataFrame) df - trips to aggregate
+        (tuple) parts - names of the stats functions to compute (keys of STATS_COLUMNS)
+    Returns:
+        state - dict of aggregates, turned into results by finalize_stats
+    """
+    state = {"rows": len(df), "parts": tuple(parts), "columns": frozenset(df.columns)}
+
+    if "time_stats" in parts and has_start_time(df.columns):
+        if all(column in df.columns for column in TIME_COLUMNS):
+            months, weekdays, hours = (df[column].to_numpy() for column in TIME_COLUMNS)
+        else:
+            start_time = pd.to_datetime(df['Start Time'], format='%Y-%m-%d %H:%M:%S', errors='coerce').dropna()
+            months, weekdays, hours = (getattr(start_time.dt, field).to_numpy() for field, _ in TIME_COLUMNS.values())
+        # The counts of trips without a valid date (month 0, weekday 7, hour 24) are left out
+        state["months"] = np.bincount(months, minlength=13)[:13]
+        state["weekdays"] = np.bincount(weekdays, minlength=8)[:7]
+        state["hours"] = np.bincount(hours, minlength=25)[:24]
+
+    if "station_stats" in parts:
+        codes = {}
+        for column, key in [('Start Station', "startStations"), ('End Station', "endStations")]:
+            if column in df.columns:
+                codes[column] = value_codes(df[column], validate_address)
+                state[key] = code_counts(*codes[column])
+        if len(codes) == 2:
+            (start_codes, start_names), (end_codes, end_names) = codes['Start Station'], codes['End Station']
+            valid = (start_codes >= 0) & (end_codes >= 0)
+            pairs, counts = np.unique(start_codes[valid].astype(np.int64) * len(end_names) + end_codes[valid], return_counts=True)
+            trips = [f"{start_names[pair // len(end_names)]} -> {end_names[pair % len(end_names)]}" for pair in pairs.tolist()]
+            # Distinct pairs may still spell the same trip
+            state["trips"] = pd.Series(counts, index=pd.Index(trips, dtype=object), dtype=np.int64).groupby(level=0).sum()
+
+    if "trip_duration_stats" in parts and 'Trip Duration' in df.columns:
+        durations = pd.to_numeric(df['Trip Duration'], errors='coerce')
+        if durations.dtype != np.float32:
+            durations = durations.astype(np.float64)
+        durations = durations.to_numpy()
+        valid = durations > 0
+        # Summed in float64 whatever the column type
+        state["durationSum"] = np.sum(durations, where=valid, dtype=np.float64)
+        state["durationCount"] = int(valid.sum())
+
+    if "user_stats" in parts:
+        for column, key, valid_values in [('User Type', "userTypes", VALID_USER_TYPES), ('Gender', "genders", VALID_GENDERS)]:
+            if column in df.columns:
+                state[key] = code_counts(*value_codes(df[column], validate_value(valid_values)))
+        if 'Birth Year' in df.columns:
+            birth_year_min = pd.to_numeric(df['Birth Year'], errors='coerce').min()
+            state["birthYearMin"] = np.nan if pd.isna(birth_year_min) else float(birth_year_min)
+
+    return state
+
+def heavy_hitters(counts: pd.Series, capacity: int) -> pd.Series:
+    """
+    Bounds a count Series to capacity values, as a Misra-Gries summary: every
+    count is lowered by the (capacity + 1)-th largest one, and the values left
+    without count are dropped. Over n trips, any value counted more than
+    n / (capacity + 1) times is kept, undercounted by at most that much, and
+    summaries can still be merged.
+    """
+    if len(counts) <= capacity:
+        return counts
+    counts = counts - counts.nlargest(capacity + 1).iloc[-1]
+    return counts[counts > 0]
 
-    # TO DO: Display the most common month
-    most_common_months = df['Start Time'].dt.month.mode()
-    if not most_common_months.empty:
-        results['mostCommonMonth'] = [calendar.month_name[int(month)].lower() for month in most_common_months]
-    else:
-        results['mostCommonMonth'] = []
-    print("The most common month(s) is/are:", results['mostCommonMonth'])
+def merge_states(states: list, trip_capacity: int | None = None) -> dict:
+    """
+    Combines aggregates from stats_state computed on disjoint sets of trips
+    into the aggregates of their union: counts and sums are added up, and the
+    earliest birth year is the minimum of the earliest ones.
 
-    # TO DO: Display the most common day of week
-    most_common_days = df['Start Time'].dt.day_name().mode()
-    if not most_common_days.empty:
-        results["mostCommonDay"] = [day_of_week.lower() for day_of_week in most_common_days]
-    else:
-        results["mostCommonDay"] = []
-    print("The most common day(s) of the week is/are: ", results["mostCommonDay"])
+    Args:
+        (list) states - non-empty list of states, computed with the same parts and columns
+        (int) trip_capacity - number of trips to keep counts for (see heavy_hitters), or None to count every trip exactly
+    Returns:
+        state - dict of aggregates, turned into results by finalize_stats
+    """
+    state = dict(states[0])
+    state["rows"] = sum(other["rows"] for other in states)
+    for key in ["months", "weekdays", "hours"]:
+        if key in state:
+            state[key] = np.sum([other[key] for other in states], axis=0)
+    for key in ["startStations", "endStations", "trips", "userTypes", "genders"]:
+        if key in state:
+            counts = pd.concat([other[key] for other in states])
+            state[key] = counts.groupby(level=0, sort=False).sum().astype(np.int64)
+    if "trips" in state and trip_capacity is not None:
+        state["trips"] = heavy_hitters(state["trips"], trip_capacity)
+    if "durationSum" in state:
+        state["durationSum"] = sum(other["durationSum"] for other in states)
+        state["durationCount"] = sum(other["durationCount"] for other in states)
+    if "birthYearMin" in state:
+        state["birthYearMin"] = min((other["birthYearMin"] for other in states if not pd.isna(other["birthYearMin"])), default=np.nan)
+    return state
+
+def most_common(counts: pd.Series) -> list:
+    """Returns every value reaching the highest count, sorted like Series.mode."""
+    if counts is None or counts.empty or counts.max() == 0:
+        return []
+    return sorted(counts.index[counts == counts.max()])
+
+def finalize_stats(state: dict) -> dict:
+    """
+    Turns aggregates from stats_state into the results of the stats functions.
 
-    # TO DO: Display the most common start hour
-    most_common_hours = df['Start Time'].dt.hour.mode()
-    if not most_common_hours.empty:
-        results["mostCommonStartHour"] = [int(hour) for hour in most_common_hours.tolist()]
-    else:
-        results["mostCommonStartHour"] = []
-    print("The most common start hour(s) is/are: ", results["mostCommonStartHour"])
+    Returns:
+        results - dict with the keys returned by time_stats, station_stats,
+        trip_duration_stats and user_stats, for the parts that were computed
+    """
+    results = {}
+    parts, columns, empty = state["parts"], state["columns"], state["rows"] == 0
+
+    if "time_stats" in parts and not empty and has_start_time(columns):
+        months = pd.Series(state["months"][1:], index=range(1, 13))
+        results['mostCommonMonth'] = [calendar.month_name[month].lower() for month in most_common(months)]
+        weekdays = pd.Series(state["weekdays"], index=[day.lower() for day in calendar.day_name])
+        results["mostCommonDay"] = most_common(weekdays)
+        results["mostCommonStartHour"] = [int(hour) for hour in most_common(pd.Series(state["hours"]))]
+
+    if "station_stats" in parts:
+        if 'Start Station' in columns:
+            results["mostCommonStartStation"] = most_common(state["startStations"])
+        if 'End Station' in columns:
+            results["mostCommonEndStation"] = most_common(state["endStations"])
+        if 'Start Station' in columns and 'End Station' in columns:
+            results["mostCommonTrip"] = most_common(state["trips"])
+
+    if "trip_duration_stats" in parts and not empty and 'Trip Duration' in columns:
+        results['totalTravelTime'] = state["durationSum"]
+        results['averageTravelTime'] = state["durationSum"] / state["durationCount"] if state["durationCount"] else np.nan
+
+    if "user_stats" in parts:
+        for column, key, result_key in [('User Type', "userTypes", 'userTypeCounts'), ('Gender', "genders", 'genderCounts')]:
+            counts = state[key] if column in columns else pd.Series(dtype=np.int64)
+            results[result_key] = counts.sort_values(ascending=False, kind="stable").to_dict()
+        birth_year_min = state.get("birthYearMin", np.nan)
+        results['earliestYearOfBirth'] = None if pd.isna(birth_year_min) else int(birth_year_min)
 
     return results
 
-@time_execution
-def station_stats(df: pd.DataFrame) -> None:
-    """Displays statistics on the most popular stations and trip."""
+def display_stats(results: dict) -> None:
+    """Prints the results of the stats functions that are present."""
+    messages = [
+        ('mostCommonMonth', "The most common month(s) is/are:", None),
+        ("mostCommonDay", "The most common day(s) of the week is/are: ", None),
+        ("mostCommonStartHour", "The most common start hour(s) is/are: ", None),
+        ("mostCommonStartStation", "The most common start station is: ", None),
+        ("mostCommonEndStation", "The most common end station is: ", None),
+        ("mostCommonTrip", "The most common trip is: ", None),
+        ('totalTravelTime', "The total travel time is: ", lambda value: f"~{round(value / 3600, 2)} hours"),
+        ('averageTravelTime', "The mean travel time is: ", lambda value: f"~{round(value / 60, 2)} mins"),
+        ('userTypeCounts', "The counts of user types are: ", None),
+        ('genderCounts', "The counts of gender are: ", None),
+        ('earliestYearOfBirth', "The earliest year of birth is: ", None),
+    ]
+    for key, message, formatter in messages:
+        if key in results:
+            print(message, formatter(results[key]) if formatter else results[key])
 
-    print("\nCalculating The Most Popular Stations and Trip...\n")
-    start_time = time.time()
-    results = {}
+@instrument
+def all_stats(df: pd.DataFrame) -> dict:
+    """Displays every statistic, computed in a single pass over the trips."""
 
-    def validate_address(value):
-        # we can imagine Nominatim API to validate the address
-        return isinstance(value, str) and bool(value.strip())
+    print("\nCalculating Bikeshare Statistics...\n")
+    results = finalize_stats(stats_state(df))
+    display_stats(results)
+    return results
 
-    # TO DO: Display most commonly used start station
-    if "Start Station" in df.columns:
-        df['Start Station'] = df['Start Station'].dropna().apply(lambda x: x if validate_address(x) else None)
-        results["mostCommonStartStation"] = df['Start Station'].mode().to_list()
-        print("The most common start station is: ", results["mostCommonStartStation"])
+@instrument
+def time_stats(df: pd.DataFrame) -> dict:
+    """Displays statistics on the most frequent times of travel."""
 
-    # TO DO: Display most commonly used end station
-    if "End Station" in df.columns:
-        df['End Station'] = df['End Station'].dropna().apply(lambda x: x if validate_address(x) else None)
-        results["mostCommonEndStation"] = df['End Station'].mode().to_list()
-        print("The most common end station is: ", results["mostCommonEndStation"])
+    print("\nCalculating The Most Frequent Times of Travel...\n")
+    if df.empty or not has_start_time(df.columns):
+        print("The DataFrame is empty or missing 'Start Time' column.")
+        return {}
 
-    # TO DO: Display most frequent combination of start station and end station trip
-    if "Start Station" in df.columns and "End Station" in df.columns:
-        results["mostCommonTrip"] = (df['Start Station'] + " -> " + df['End Station']).mode().to_list()
-        print("The most common trip is: ", results["mostCommonTrip"])
+    results = finalize_stats(stats_state(df, ("time_stats",)))
+    display_stats(results)
+    return results
+
+@instrument
+def station_stats(df: pd.DataFrame) -> dict:
+    """Displays statistics on the most popular stations and trip."""
 
+    print("\nCalculating The Most Popular Stations and Trip...\n")
+    results = finalize_stats(stats_state(df, ("station_stats",)))
+    display_stats(results)
     return results
 
-@time_execution
-def trip_duration_stats(df: pd.DataFrame) -> None:
+@instrument
+def trip_duration_stats(df: pd.DataFrame) -> dict:
     """Displays statistics on the total and average trip duration."""
 
     print("\nCalculating Trip Duration...\n")
-    start_time = time.time()
-    results = {}
-
     if df.empty or "Trip Duration" not in df.columns:
         print("The DataFrame is missing 'Trip Duration' column.")
-        return results
-
-    df['Trip Duration'] = pd.to_numeric(df['Trip Duration'], errors='coerce')
-    df['Trip Duration'] = df['Trip Duration'].dropna()
-    df['Trip Duration'] = df[df['Trip Duration'] > 0]['Trip Duration']
-
-    # TO DO: Display total travel time
-    results['totalTravelTime'] = df['Trip Duration'].sum()
-    print("The total travel time is: ", f"~{round(results['totalTravelTime'] / 3600, 2)} hours")
-
-    # TO DO: Display mean travel time
-    results['averageTravelTime'] = df['Trip Duration'].mean()
-    print("The mean travel time is: ", f"~{round(results['averageTravelTime'] / 60, 2)} mins")
+        return {}
 
+    results = finalize_stats(stats_state(df, ("trip_duration_stats",)))
+    display_stats(results)
     return results
 
-@time_execution
-def user_stats(df: pd.DataFrame) -> None:
+@instrument
+def user_stats(df: pd.DataFrame) -> dict:
     """Displays statistics on bikeshare users."""
 
     print("\nCalculating User Stats...\n")
-    start_time = time.time()
-    results = {}
+    results = finalize_stats(stats_state(df, ("user_stats",)))
+    display_stats(results)
+    return results
 
-    # TO DO: Display counts of user types
-    if 'User Type' in df.columns:
-        results['userTypeCounts'] = df[df['User Type'].isin(VALID_USER_TYPES)]['User Type'].value_counts(dropna=True).to_dict()
-        print("The counts of user types are: ", results["userTypeCounts"])
-    else:
-        results['userTypeCounts'] = {}
+@instrument
+def stream_stats(city: str, month: str = "all", day: str = "all", chunk_rows: int = CSV_CHUNK_ROWS, trip_capacity: int | None = None) -> dict:
+    """
+    Returns every statistic of a city, like all_stats on load_data, reading
+    the CSV chunk by chunk: only one chunk and the merged aggregates are in
+    memory at a time, so a city larger than RAM can be analyzed.
 
-    # TO DO: Display counts of gender
-    if 'Gender' in df.columns:
-        results['genderCounts'] = df[df['Gender'].isin(VALID_GENDERS)]['Gender'].value_counts(dropna=True).to_dict()
-        print("The counts of gender are: ", results['genderCounts'])
+    Args:
+        (str) city - name of the city to analyze
+        (str) month - name of the month to filter by, or "all" to apply no month filter
+        (str) day - name of the day of week to filter by, or "all" to apply no day filter
+        (int) chunk_rows - number of CSV rows parsed at once
+        (int) trip_capacity - bound on the trips counted, making mostCommonTrip
+            approximate (see heavy_hitters), or None to count every trip exactly
+    Returns:
+        results - dict with the keys returned by all_stats
+    """
+    state = None
+    for chunk in iter_city_csv(city, *filter_numbers(month, day), sum(STATS_COLUMNS.values(), []), chunk_rows):
+        states = [stats_state(chunk)] if state is None else [state, stats_state(chunk)]
+        state = merge_states(states, trip_capacity)
+    return finalize_stats(state)
+
+# Built cubes, by source CSV path, size and modification time
+CUBES = {}
+
+@instrument
+def build_cube(city: str) -> dict:
+    """
+    Computes the aggregates of a city for every (month, weekday) of
+    'Start Time', month 0 and weekday 7 holding the trips without a valid
+    date, then derives from them the results of every filter choice.
+
+    Returns:
+        cube - dict with "cells", the stats_state of each (month, weekday),
+        and "results", the results of all_stats for each (month, day) choice
+        of get_filters
+    """
+    df = load_data(city, "all", "all", columns=sum(STATS_COLUMNS.values(), []))
+    if 'Start Month' in df.columns:
+        keys = [df['Start Month'], df['Start Weekday']]
     else:
-        results['genderCounts'] = {}
-
-    # TO DO: Display earliest, most recent, and most common year of birth
-    if 'Birth Year' in df.columns:
-        df["Birth Year"] = df["Birth Year"].dropna()
-        df['Birth Year'] = pd.to_numeric(df['Birth Year'], errors='coerce')
-        results['earliestYearOfBirth'] = int(df['Birth Year'].min())
-        print("The earliest year of birth is: ", results['earliestYearOfBirth'])
+        keys = [np.zeros(len(df), dtype=np.int8), np.full(len(df), 7, dtype=np.int8)]
+    cells = {key: stats_state(group) for key, group in df.groupby(keys)}
+    # Identity of merge_states, so that choices without trips get the results of an empty selection
+    empty = stats_state(df.iloc[:0])
+
+    results = {}
+    for month_number, month in enumerate(MONTHS):
+        for day_number, day in enumerate(DAYS):
+            if month == "all" and day == "all":
+                selected = list(cells.values())
+            else:
+                selected = [
+                    cell for (cell_month, cell_weekday), cell in cells.items()
+                    if cell_month != 0 and month in ("all", MONTHS[cell_month]) and day in ("all", DAYS[cell_weekday + 1])
+                ]
+            results[(month, day)] = finalize_stats(merge_states([empty] + selected))
+    return {"cells": cells, "results": results}
+
+def city_cube(city: str) -> dict:
+    """
+    Returns the cube of a city (see build_cube), loading it from the city
+    cache directory, or building and storing it there first. The cube is
+    kept in memory afterwards, until the source CSV changes.
+    """
+    source = CITY_DATA[city]
+    stat = os.stat(source)
+    key = (source, stat.st_size, stat.st_mtime_ns)
+    if key in CUBES:
+        return CUBES[key]
+
+    cube_path = os.path.join(city_cache(city), CUBE_FILE) if feather is not None else None
+    if cube_path and os.path.exists(cube_path):
+        with open(cube_path, "rb") as f:
+            cube = pickle.load(f)
     else:
-        results['earliestYearOfBirth'] = None
+        cube = build_cube(city)
+        if cube_path:
+            # Renamed once complete, so a concurrent reader never sees a partial cube
+            with tempfile.NamedTemporaryFile(dir=os.path.dirname(cube_path), delete=False) as f:
+                pickle.dump(cube, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(f.name, cube_path)
+    CUBES[key] = cube
+    return cube
+
+def cube_stats(city: str, month: str, day: str) -> dict:
+    """
+    Returns every statistic of a city for a month and day choice of
+    get_filters, read from the city cube instead of the trips.
+
+    Args:
+        (str) city - name of the city to analyze
+        (str) month - name of the month to filter by, or "all" to apply no month filter
+        (str) day - name of the day of week to filter by, or "all" to apply no day filter
+    Returns:
+        results - the results of all_stats on load_data(city, month, day), shared with the cube (not to be modified)
+    """
+    return city_cube(city)["results"][(month, day)]
+
+@instrument
+def filtered_stats(city: str, month: str, day: str) -> dict:
+    """Displays every statistic of a city for a month and day choice, from the city cube."""
 
+    print("\nCalculating Bikeshare Statistics...\n")
+    results = cube_stats(city, month, day)
+    display_stats(results)
     return results
 
+def configure(city_data: dict, cache_directory: str) -> None:
+    """Points a worker process to the same data and cache as its parent."""
+    global CACHE_DIRECTORY
+    CITY_DATA.clear()
+    CITY_DATA.update(city_data)
+    CACHE_DIRECTORY = cache_directory
+
+@instrument
+def city_stats(city: str, month: str, day: str) -> dict:
+    """Returns every statistic of a city, from its cube, without displaying them."""
+    return cube_stats(city, month, day)
+
+def display_comparison(comparison: dict) -> None:
+    """Prints the statistics of each city, one city after the other."""
+    for city, results in comparison.items():
+        print(f"\n{city.title()}\n{'-' * len(city)}")
+        display_stats(results)
+
+@instrument
+def compare_cities(month: str = "all", day: str = "all", cities: list | None = None, workers: int | None = None) -> dict:
+    """
+    Displays every statistic of several cities, each city being loaded and
+    computed in its own process, so the report takes about as long as the
+    slowest city.
+
+    Args:
+        (str) month - name of the month to filter by, or "all" to apply no month filter
+        (str) day - name of the day of week to filter by, or "all" to apply no day filter
+        (list) cities - names of the cities to compare, or None for every city of CITY_DATA
+        (int) workers - number of processes, or None for one per city (up to the CPU count)
+    Returns:
+        comparison - dict of city name to the results of all_stats
+    """
+    cities = list(CITY_DATA) if cities is None else list(cities)
+    workers = workers or min(len(cities), os.cpu_count() or 1)
+
+    print("\nComparing Bikeshare Statistics...\n")
+    with ProcessPoolExecutor(workers, initializer=configure, initargs=(dict(CITY_DATA), CACHE_DIRECTORY)) as executor:
+        comparison = dict(zip(cities, executor.map(city_stats, cities, repeat(month), repeat(day))))
+    display_comparison(comparison)
+    return comparison
+
 def main() -> None:
     while True:
         city, month, day = get_filters()
-        df = load_data(city, month, day)
-
-        time_stats(df)
-        station_stats(df)
-        trip_duration_stats(df)
-        user_stats(df)
+        if city == "all":
+            compare_cities(month, day)
+        else:
+            filtered_stats(city, month, day)
 
         restart = input("\nWould you like to restart? Enter yes or no.\n")
         if restart.lower() != "yes":
@@ -1,7 +1,13 @@
+import json
+import os
+import tempfile
+import tracemalloc
 import unittest
+from unittest import mock
 import pandas as pd
 import numpy as np
-from bike_investigation import time_stats, station_stats, trip_duration_stats, user_stats
+import bike_investigation
+from bike_investigation import time_stats, station_stats, trip_duration_stats, user_stats, all_stats, load_data
 
 #############################
 #        TESTS OVERVIEW     #
@@ -43,6 +49,29 @@ from bike_investigation import time_stats, station_stats, trip_duration_stats, u
 # - test_trip_duration_stats_column: Check response to missing columns in trip duration stats.
 # - test_user_stats_column: Assess behavior when user stats columns are absent.
 
+# ===========================
+#        ALL STATS TESTS
+# ===========================
+# - test_all_stats: Check that the single-pass engine matches the four stats functions.
+# - test_all_stats_no_mutation: Ensure the stats don't modify the DataFrame.
+# - test_all_stats_empty: Check the results of an empty selection.
+# - test_merge_states: Check that merged partial aggregates give the results of the whole data.
+# - test_heavy_hitters: Check that bounded trip counts keep the frequent trips.
+
+# ===========================
+#        LOAD DATA TESTS
+# ===========================
+# - test_load_data_cache: Check that cached loads return the same data as the CSV.
+# - test_load_data_cache_invalidation: Ensure a modified CSV invalidates its cache.
+# - test_load_data_pushdown: Check month/day filters and column selection, with and without the cache.
+# - test_load_data_compact: Check the compact column types, and that the stats read them without modifying them.
+# - test_compare_cities: Check that the parallel comparison matches all_stats for each city.
+# - test_cube_stats: Check that the cube answers every filter choice like the stats functions.
+# - test_cube_persisted: Ensure the cube is stored in the cache and not rebuilt.
+# - test_stream_stats: Check that the chunked path matches the stats of the loaded data.
+# - test_stage_metrics: Check the JSON line metrics of nested stages, rows in and out included.
+# - test_stage_profiler: Ensure the profilers dump their output for the outermost stage only.
+
 #############################
 
 
@@ -259,5 +288,252 @@ class TestBikeShareData(unittest.TestCase):
         self.assertEqual(result['earliestYearOfBirth'], None)
 
 
+    ### ALL STATS ###
+
+    def all_stats_data(self):
+        return pd.DataFrame({
+            'Start Time': ['2017-01-01 09:07:57', '2017-01-02 09:07:57', 'UNRECOGNIZED_VALUE', '2017-02-03 00:07:57', None],
+            'Start Station': ['A', 'B', 123, 'A', ''],
+            'End Station': ['B', None, {1: 2}, 'B', 'C'],
+            'Trip Duration': [100, 200, -100, 'UNRECOGNIZED_VALUE', 300],
+            'User Type': ['Subscriber', 'Customer', 'test', None, 'Subscriber'],
+            'Gender': ['Male', 'Unicorn', 'Female', 'Male', None],
+            'Birth Year': ["1915", 1989, "abc", None, 2001],
+        })
+
+    def test_all_stats(self):
+        expected = {}
+        for stats in [time_stats, station_stats, trip_duration_stats, user_stats]:
+            expected.update(stats(self.all_stats_data()))
+
+        self.assertEqual(all_stats(self.all_stats_data()), expected)
+
+    def test_all_stats_no_mutation(self):
+        df = self.all_stats_data()
+
+        all_stats(df)
+
+        pd.testing.assert_frame_equal(df, self.all_stats_data())
+
+    def test_all_stats_empty(self):
+        result = all_stats(self.all_stats_data().iloc[:0])
+
+        self.assertEqual(result, {
+            'mostCommonStartStation': [],
+            'mostCommonEndStation': [],
+            'mostCommonTrip': [],
+            'userTypeCounts': {},
+            'genderCounts': {},
+            'earliestYearOfBirth': None,
+        })
+
+    def test_merge_states(self):
+        df = self.all_stats_data()
+        expected = bike_investigation.finalize_stats(bike_investigation.stats_state(df))
+
+        states = [bike_investigation.stats_state(part) for part in (df.iloc[:2], df.iloc[2:2], df.iloc[2:])]
+
+        self.assertEqual(bike_investigation.finalize_stats(bike_investigation.merge_states(states)), expected)
+
+    def test_heavy_hitters(self):
+        counts = pd.Series({'A -> B': 5, 'B -> C': 1, 'C -> D': 1, 'D -> E': 2})
+
+        self.assertEqual(bike_investigation.heavy_hitters(counts, 4).to_dict(), counts.to_dict())
+        self.assertEqual(bike_investigation.heavy_hitters(counts, 2).to_dict(), {'A -> B': 4, 'D -> E': 1})
+        self.assertEqual(bike_investigation.heavy_hitters(counts, 1).to_dict(), {'A -> B': 3})
+
+
+CSV_DATA = """Unnamed: 0,Start Time,End Time,Trip Duration,Start Station,End Station,User Type,Gender,Birth Year
+1,2017-01-01 09:07:57,2017-01-01 09:20:53,776.0,A,B,Subscriber,Male,1989.0
+2,2017-01-02 09:07:57,2017-01-02 09:20:53,776.0,B,A,Customer,,
+3,2017-03-03 00:07:57,2017-03-03 00:20:53,776.0,A,B,Subscriber,Female,1992.0
+"""
+
+
+class TestLoadData(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.csv_path = os.path.join(self.directory.name, "chicago.csv")
+        with open(self.csv_path, "w") as f:
+            f.write(CSV_DATA)
+        self.cache_directory = os.path.join(self.directory.name, ".cache")
+        self.patches = [
+            mock.patch.dict(bike_investigation.CITY_DATA, {"chicago": self.csv_path}),
+            mock.patch.object(bike_investigation, "CACHE_DIRECTORY", self.cache_directory),
+            mock.patch.object(bike_investigation, "CUBES", {}),
+            mock.patch.object(bike_investigation, "METRICS_FILE", os.path.join(self.directory.name, "metrics.jsonl")),
+            mock.patch.object(bike_investigation, "PROFILER", None),
+            mock.patch.object(bike_investigation, "PROFILE_DIRECTORY", os.path.join(self.directory.name, ".profiles")),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        self.directory.cleanup()
+
+    @unittest.skipIf(bike_investigation.feather is None, "pyarrow is not installed")
+    def test_load_data_cache(self):
+        expected = bike_investigation.add_time_columns(pd.read_csv(self.csv_path, dtype=bike_investigation.DTYPES, parse_dates=['Start Time', 'End Time']))
+
+        first = load_data("chicago", "all", "all")
+        self.assertEqual(len(os.listdir(self.cache_directory)), 1)
+        second = load_data("chicago", "all", "all")
+
+        pd.testing.assert_frame_equal(first, expected)
+        pd.testing.assert_frame_equal(second, expected)
+        self.assertEqual(len(load_data("chicago", "january", "monday")), 1)
+
+    @unittest.skipIf(bike_investigation.feather is None, "pyarrow is not installed")
+    def test_load_data_cache_invalidation(self):
+        load_data("chicago", "all", "all")
+        with open(self.csv_path, "a") as f:
+            f.write("4,2017-03-04 00:07:57,2017-03-04 00:20:53,776.0,C,D,Customer,Male,2000.0\n")
+
+        self.assertEqual(len(load_data("chicago", "all", "all")), 4)
+        self.assertEqual(len(os.listdir(self.cache_directory)), 1)
+
+    def test_load_data_pushdown(self):
+        for feather in {bike_investigation.feather, None}:
+            with mock.patch.object(bike_investigation, "feather", feather):
+                df = load_data("chicago", "january", "monday", columns=['Trip Duration', 'Gender'])
+                self.assertEqual(df.columns.tolist(), ['Trip Duration', 'Gender'])
+                self.assertEqual(df.index.tolist(), [1])
+
+                df = load_data("chicago", "march", "all", columns=bike_investigation.STATS_COLUMNS["time_stats"])
+                self.assertEqual(df.columns.tolist(), list(bike_investigation.TIME_COLUMNS))
+                self.assertEqual(df.index.tolist(), [2])
+
+                self.assertTrue(load_data("chicago", "june", "all").empty)
+                self.assertEqual(load_data("chicago", "all", "all").index.tolist(), [0, 1, 2])
+
+    def test_load_data_compact(self):
+        with open(self.csv_path, "a") as f:
+            f.write("4,2017-03-06 18:07:57,2017-03-06 18:20:53,100.5,C,D,Customer,Male,2000.0\n")
+            f.write("5,,,50.25,C,A,Subscriber,Female,\n")
+        expected = {
+            'Trip Duration': 'float32', 'Start Station': 'category', 'End Station': 'category', 'User Type': 'category',
+            'Gender': 'category', 'Birth Year': 'Int16', 'Start Month': 'int8', 'Start Weekday': 'int8', 'Start Hour': 'int8',
+        }
+
+        # One row per chunk, so the categories have to be merged
+        for feather, chunk_rows in {(bike_investigation.feather, 100), (None, 1)}:
+            with mock.patch.object(bike_investigation, "feather", feather), mock.patch.object(bike_investigation, "CSV_CHUNK_ROWS", chunk_rows):
+                df = load_data("chicago", "all", "all", columns=sum(bike_investigation.STATS_COLUMNS.values(), []))
+            self.assertEqual(df.dtypes.astype(str).to_dict(), expected)
+            self.assertEqual(df['Start Station'].tolist(), ['A', 'B', 'A', 'C', 'C'])
+            self.assertEqual(df['Start Month'].tolist(), [1, 1, 3, 3, 0])
+            self.assertEqual(df['Start Weekday'].tolist(), [6, 0, 4, 0, 7])
+            self.assertTrue(df['Birth Year'].isna().tolist()[-1])
+
+            original = df.copy()
+            results = all_stats(df)
+            pd.testing.assert_frame_equal(df, original)
+            raw = pd.read_csv(self.csv_path, dtype=str)
+            self.assertEqual(results, all_stats(raw.assign(**{'Trip Duration': raw['Trip Duration'].astype(float), 'Birth Year': raw['Birth Year'].astype(float)})))
+
+    def test_compare_cities(self):
+        washington_path = os.path.join(self.directory.name, "washington.csv")
+        with open(washington_path, "w") as f:
+            f.write(CSV_DATA.replace(",A,B,", ",C,D,"))
+
+        with mock.patch.dict(bike_investigation.CITY_DATA, {"washington": washington_path}):
+            comparison = bike_investigation.compare_cities("all", "all", cities=["chicago", "washington"], workers=2)
+            expected = {city: all_stats(load_data(city, "all", "all")) for city in ["chicago", "washington"]}
+
+        self.assertEqual(comparison, expected)
+        self.assertEqual(comparison["washington"]["mostCommonTrip"], ["C -> D"])
+
+    def test_cube_stats(self):
+        with open(self.csv_path, "a") as f:
+            f.write("4,2017-03-06 18:07:57,2017-03-06 18:20:53,100.5,C,D,Customer,Male,2000.0\n")
+            f.write("5,,,50.25,C,A,Subscriber,Female,1950.0\n")
+
+        for month in bike_investigation.MONTHS:
+            for day in bike_investigation.DAYS:
+                df = load_data("chicago", month, day, columns=sum(bike_investigation.STATS_COLUMNS.values(), []))
+                expected = bike_investigation.finalize_stats(bike_investigation.stats_state(df))
+                self.assertEqual(bike_investigation.cube_stats("chicago", month, day), expected, (month, day))
+
+    def test_stream_stats(self):
+        with open(self.csv_path, "a") as f:
+            f.write("4,2017-03-06 18:07:57,2017-03-06 18:20:53,100.5,C,D,Customer,Male,2000.0\n")
+            f.write("5,,,50.25,C,A,Subscriber,Female,1950.0\n")
+
+        for month, day in [("all", "all"), ("march", "all"), ("all", "monday"), ("june", "all")]:
+            df = load_data("chicago", month, day, columns=sum(bike_investigation.STATS_COLUMNS.values(), []))
+            expected = bike_investigation.finalize_stats(bike_investigation.stats_state(df))
+            for chunk_rows in [1, 2, 100]:
+                self.assertEqual(bike_investigation.stream_stats("chicago", month, day, chunk_rows=chunk_rows), expected, (month, day, chunk_rows))
+
+        # A -> B makes more than half of the trips, so one counter is enough to find it
+        with open(self.csv_path, "a") as f:
+            f.write("6,2017-03-07 18:07:57,2017-03-07 18:20:53,60.0,A,B,Customer,Male,2000.0\n" * 2)
+        results = bike_investigation.stream_stats("chicago", chunk_rows=1, trip_capacity=1)
+        self.assertEqual(results["mostCommonTrip"], ["A -> B"])
+
+    def read_metrics(self) -> list:
+        with open(bike_investigation.METRICS_FILE) as f:
+            return [json.loads(line) for line in f]
+
+    def test_stage_metrics(self):
+        with mock.patch.object(bike_investigation, "feather", None):
+            df = load_data("chicago", "january", "all")
+        all_stats(df)
+        bike_investigation.stream_stats("chicago", "march", chunk_rows=1)
+
+        metrics = self.read_metrics()
+        self.assertEqual([(metric["stage"], metric["rows_in"], metric["rows_out"]) for metric in metrics], [
+            ("load_data", 3, 2), ("all_stats", 2, None), ("stream_stats", 3, 1),
+        ])
+        self.assertEqual(metrics[0]["arguments"], {"city": "chicago", "month": "january", "day": "all"})
+        for metric in metrics:
+            self.assertIsNone(metric["parent"])
+            self.assertGreater(metric["elapsed_ns"], 0)
+            self.assertGreaterEqual(metric["peak_rss_delta"], 0)
+
+        with bike_investigation.stage("outer") as outer:
+            with bike_investigation.stage("inner"):
+                bike_investigation.count_rows(5, 2)
+                bike_investigation.count_rows(1)
+            outer["rows_in"] = 6
+        with self.assertRaises(ValueError), bike_investigation.stage("failing"):
+            raise ValueError
+
+        inner, outer, failing = self.read_metrics()[3:]
+        self.assertEqual((inner["stage"], inner["parent"], inner["rows_in"], inner["rows_out"]), ("inner", "outer", 6, 2))
+        self.assertEqual((outer["stage"], outer["parent"], outer["rows_in"]), ("outer", None, 6))
+        self.assertEqual(failing["error"], "ValueError")
+        self.assertEqual(bike_investigation.STAGES, [])
+
+    def test_stage_profiler(self):
+        for profiler, extension in [("cprofile", ".prof"), ("tracemalloc", ".tracemalloc")]:
+            with mock.patch.object(bike_investigation, "PROFILER", profiler):
+                with bike_investigation.stage("outer"):
+                    with bike_investigation.stage("inner"):
+                        data = [0] * 100_000
+                    del data
+            self.assertFalse(tracemalloc.is_tracing())
+
+            inner, outer = self.read_metrics()[-2:]
+            self.assertNotIn("profile", inner)
+            self.assertTrue(outer["profile"].endswith(extension) and os.path.exists(outer["profile"]))
+            if profiler == "tracemalloc":
+                self.assertGreaterEqual(inner["traced_peak_delta"], 800_000)
+                self.assertGreaterEqual(outer["traced_peak_delta"], inner["traced_peak_delta"])
+
+    @unittest.skipIf(bike_investigation.feather is None, "pyarrow is not installed")
+    def test_cube_persisted(self):
+        expected = bike_investigation.cube_stats("chicago", "january", "all")
+        bike_investigation.CUBES.clear()
+
+        with mock.patch.object(bike_investigation, "build_cube", side_effect=AssertionError("rebuilt")):
+            self.assertEqual(bike_investigation.cube_stats("chicago", "january", "all"), expected)
+        cache_path, = os.listdir(self.cache_directory)
+        self.assertIn(bike_investigation.CUBE_FILE, os.listdir(os.path.join(self.cache_directory, cache_path)))
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file